@@ -17,173 +17,95 @@
 #    --------    --------    ------------------------------------------------------------
 #    tismith     08/22/24    -   added support email
 #                            -   added APICallFailedException for XIQ errors
+#                06/14/26    -   rotate multiple SSIDs in one run with a shared config push
+#                06/21/26    -   moved rotation to app/rotator.py, added --daemon mode
+#                10/18/26    -   added --worker mode with a shared, leased job table
+#                            -   added --profile to write a per stage profile next to the log
 #########################################################################################
 
+import argparse
 import logging
 import os
-import csv
 import yaml
-from app.logger import logger
-from app.xiq_api import XIQ, APICallFailedException
-import app.gmail as gmail_client
-import app.smtp as smtp_client
-from pprint import pprint as pp
+from app.logger import logger, logFile
+from app.metrics import RunMetrics
+from app.rotator import Rotator, RotationAborted, load_config, write_run_report
 logger = logging.getLogger('PSK_Rotator.Main')
 
 PATH = os.path.dirname(os.path.abspath(__file__))
 
- # search for variables.yml
-try:
-    with open(f"{PATH}/variables.yml", "r") as f:
-        yml_variables = yaml.safe_load(f)
-except FileNotFoundError:
-    logger.error("variables.yml file not found")
-    raise SystemExit
-except yaml.YAMLError:
-    logger.error("variables.yml file is corrupt")
-    raise SystemExit
 
+def main():
+    parser = argparse.ArgumentParser(description="Rotate the PSK of XIQ SSIDs")
+    parser.add_argument('-c', '--config', default=f"{PATH}/variables.yml", help="path to the variables.yml file to use")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and rotate each SSID on its cron 'schedule' from variables.yml")
+    parser.add_argument('--worker', action='store_true',
+                        help="keep running and share the scheduled rotations of --tenants with other workers through --jobs")
+    parser.add_argument('--jobs', default=f"{PATH}/psk_jobs.db", help="SQLite job table shared by the workers")
+    parser.add_argument('--tenants', nargs='+', help="variables.yml file of every tenant this worker rotates (default --config)")
+    parser.add_argument('--lease-time', type=int, default=300, help="seconds a claimed job is held without a heartbeat")
+    parser.add_argument('--profile', action='store_true',
+                        help="profile a single run and write the hot spots of every stage next to the log")
+    parser.add_argument('--profile-top', type=int, default=15, help="hot spots listed per stage with --profile")
+    parser.add_argument('--profile-interval', type=float, default=0.005, help="seconds between --profile samples")
+    args = parser.parse_args()
+
+    if args.daemon:
+        # imported here so single runs do not load the scheduler
+        from app.scheduler import Daemon
+        Daemon(args.config, PATH).run_forever()
+        return
+    if args.worker:
+        from app.worker import Worker
+        Worker(args.tenants or [args.config], args.jobs, PATH, lease_time=args.lease_time,
+               heartbeat_interval=max(1, args.lease_time // 5)).run_forever()
+        return
+
+    # timings of every XIQ call and every stage of the run
+    metrics = RunMetrics()
+    profiler = None
+    if args.profile:
+        # imported here so normal runs do not load the profiler
+        from app.profiler import StageProfiler
+        profiler = StageProfiler(interval=args.profile_interval, top_n=args.profile_top)
+        metrics.add_stage_hook(profiler.hook)
+        profiler.start()
+
+     # search for variables.yml
+    try:
+        with metrics.stage("config_load"):
+            yml_variables = load_config(args.config)
+    except FileNotFoundError:
+        logger.error(f"variables.yml file not found - {args.config}")
+        write_profile(profiler)
+        raise SystemExit
+    except yaml.YAMLError:
+        logger.error("variables.yml file is corrupt")
+        write_profile(profiler)
+        raise SystemExit
 
-# CSV Functions
-#################################################################################################
-def write_to_csv(data, output_file):
-    with open(output_file, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(data)
-
-# Email Functions
-#################################################################################################
-def send_email(isSuccess, msg, recipients):
-    # check 'email_type' variable
-    if yml_variables['email_type'] == 'gmail':
-        send_gmail(msg, recipients)
-    elif yml_variables['email_type'] == 'smtp':
-        send_smtp(msg, recipients)
-    elif yml_variables['email_type'] == 'disabled':
-        print("emailing is disabled in yaml variable file. Message will only be logged.")
-        logger.info(f"Script was successful: {isSuccess}")
-        logger.info(f"Email is disabled. Email message: {msg}")
-    else:
-        print(f"email_type in variables.yml is incorrect - '{yml_variables['email_type']}'. Message will only be logged.")
-        logger.info(f"Script was successful: {isSuccess}")
-        logger.info(f"email_type in variable.yml is incorrect - '{yml_variables['email_type']}'. Email message: {msg}")
-
-def send_gmail(msg, recipients):
-    # open gmail_client
-    service = gmail_client.new(yml_variables)
-    service.send_message(body=(f"{msg}"), recipients=recipients)
-
-def send_smtp(msg, recipients):
-    service = smtp_client.new(yml_variables)
-    service.send_message(body=(f"{msg}"), recipients=recipients)
-    
-#################################################################################################
-# Main
-#################################################################################################
-
-if 'XIQ_token' in yml_variables:
-    x = XIQ(token=yml_variables['XIQ_token'])
-else:
-    log_msg = ("No XIQ API token provided. Please generate a token and run the script again.")
-    print(log_msg)
-    # log message
-    logger.error(log_msg)
-    # send message to support email
-    log_msg += " Please check variables.yml"
-    send_email(False, log_msg, yml_variables['support_email_list'])
-    raise SystemExit
-
-
-# read csv file
-if os.path.exists(yml_variables['file_name']):
-    with open(yml_variables['file_name'], 'r') as csv_f:
-        reader = csv.reader(csv_f)
-        psk_list = list(reader)
-else:
-    log_msg = f"File {yml_variables['file_name']} does not exist."
-    logger.error(log_msg)
-    print("Failed")
-    print(log_msg)
-    # send message to support email
-    log_msg += " Please check variables.yml"
-    send_email(False, log_msg, yml_variables['support_email_list'])
-    raise SystemExit     
-
-if not psk_list:
-    log_msg = (f"The PSK CSV file {yml_variables['file_name']} is empty")
-    logger.warning(log_msg)
-    print(log_msg)
-    # send message to support email
-    send_email(False, log_msg, yml_variables['support_email_list'])
-    print("Script is exiting...")
-    raise SystemExit
-
-# Check for any devices in mismatched state. 
-try:
-    mismatched_devices = x.collectMismatchDevices()
-except APICallFailedException as e:
-    # send message to support email
-    send_email(False, f"Script failed to collect devices in mismatched state.\n - {str(e)}\nCheck logs for more details", yml_variables['support_email_list'])
-if len(mismatched_devices) > 0 and not yml_variables['allow_mismatched']:
-    #Do this is mismatched devices and allow_mismatched is set to False
-    log_msg = f"Mismatches devices were found in XIQ. Yaml settings are set to not allow mismatches. PSK will not be changed"
-    logger.warning(log_msg)
-    log_msg += f"\n\nThe following APs are in a mismatched state: \n{chr(10).join([d['hostname'] for d in mismatched_devices])}"
-    # send message to support email
-    send_email(False, log_msg, yml_variables['support_email_list'])
-    print("Script is exiting...")
-    raise SystemExit
-        
-
-email_body = ''
-
-new_psk = psk_list.pop(0)[0]
+    rotator = Rotator(yml_variables)
+    try:
+        rotator.rotate(metrics=metrics)
+    except RotationAborted:
+        raise SystemExit
+    finally:
+        rotator.close()
+        write_run_report(yml_variables, metrics, PATH)
+        write_profile(profiler)
 
-psk_updated = False
-response = x.change_PSK(yml_variables['SSID_ID'],new_psk)
-if response == "Success":
-    psk_updated = True
-    logger.info(f"Successfully updated psk to {new_psk}")
-    # add psk to end of list if reuse_psks is True
-    if yml_variables['reuse_psks']:
-        psk_list.append([new_psk])
-    #update csv 
-    write_to_csv(psk_list, yml_variables['file_name'])
-    logger.info(f"Successfully updated csv file {yml_variables['file_name']}")
-    email_body += f"{yml_variables['email_msg']} {new_psk}\n\n"
-else:
-    email_body += f"Script failed to change PSK. Please check logs\n\n"
 
-config_status_msg = ""
-if yml_variables['allow_config_push'] and psk_updated:
+def write_profile(profiler):
+    # --profile results go next to the log file
+    if profiler is None:
+        return
+    profiler.stop()
     try:
-        devices = x.collectMismatchDevices(wait_time=60)
-    except APICallFailedException as e:
-        # send message to support email
-        send_email(False, f"PSK has been added by script but failed to collect devices for config push.\n - {str(e)}.\nCheck logs for more details", yml_variables['support_email_list'])
-        print("Script is exiting...")
-        raise SystemExit
-    if devices:
-        try:
-            config_status = x.configPushToDevices([device['id'] for device in devices])
-        except APICallFailedException as e:
-            # send message to support email
-            send_email(False, f"PSK has been added by script but failed to push the configuration with errors.\n - {str(e)}.\nCheck logs for more details", yml_variables['support_email_list'])
-            print("Script is exiting...")
-            raise SystemExit
-        if config_status != "SUCCEEDED":
-            if config_status[-2:] == 'ED' :
-                config_status_msg = f"The configuration push {config_status}"
-            else:
-                config_status_msg = f"The configuration push is {config_status}"
-    else:
-        config_status_msg = f"There are currently no online devices"
-elif not yml_variables['allow_config_push'] and psk_updated:
-    config_status_msg = 'Configuration pushing is disabled in script. New PSK will be used once configuration is pushed.'
+        print(f"Profile written to {profiler.write(os.path.dirname(logFile))}")
+    except OSError as e:
+        logger.error(f"Failed to write the profile - {e}")
+
 
-email_body += config_status_msg
-if psk_updated:
-    send_email(psk_updated, email_body, yml_variables['email_list'])
-else:
-    # send message to support email
-    send_email(psk_updated, email_body, yml_variables['support_email_list'])
\ No newline at end of file
+if __name__ == '__main__':
+    main()
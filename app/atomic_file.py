@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+
+# read once at import, os.umask() can only be read by setting it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def atomic_write(path, data, file_mode=None):
+    # Writes data (str or bytes) to a temp file in the same folder and swaps it in, so readers see either
+    # the old or the new file and processes writing the same path do not share a temp file. The file keeps
+    # the permissions of the file it replaces (a new file gets the umask default) unless file_mode is given.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(data, bytes) else os.fdopen(fd, 'w', newline='')) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file as 0600
+        if file_mode is not None:
+            os.chmod(tmp_path, file_mode)
+        elif os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
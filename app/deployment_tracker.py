@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.deployment_tracker')
+
+# per device states, kept as small ints so 100k devices cost one dict entry each
+PENDING, RUNNING, SUCCEEDED, FAILED = range(4)
+STATE_NAMES = ("PENDING", "RUNNING", "SUCCEEDED", "FAILED")
+
+
+def parse_device_status(entry):
+    # one device from /deployments/status -> a state
+    status = str(entry.get('status') or entry.get('current_status') or "").upper()
+    if "FAIL" in status:
+        return FAILED
+    if status == "SUCCEEDED" or entry.get('finished'):
+        return SUCCEEDED
+    if status in ("", "PENDING", "QUEUED"):
+        return PENDING
+    return RUNNING
+
+
+class DeploymentTracker:
+    # Follows the deployment of every device of a config push. fetch_status(device_ids) returns the
+    # /deployments/status entries for up to page_size devices, keyed by device id. update() asks only
+    # for devices that have not finished, logs every device that failed as soon as it is seen and
+    # keeps the per state counts in metrics.
+    def __init__(self, fetch_status, device_ids, page_size=100, metrics=None):
+        self.fetch_status = fetch_status
+        self.page_size = page_size
+        self.metrics = metrics
+        self.states = dict.fromkeys(device_ids, PENDING)
+        self.lock = threading.Lock()
+
+    def update(self, device_ids=None):
+        # refreshes device_ids (default all) page by page. Returns the counts per state name
+        device_ids = self.unfinished(device_ids)
+        for start in range(0, len(device_ids), self.page_size):
+            page = device_ids[start:start + self.page_size]
+            entries = self.fetch_status(page)
+            for device_id in page:
+                entry = entries.get(str(device_id)) or entries.get(device_id)
+                if entry is None:
+                    continue
+                state = parse_device_status(entry)
+                with self.lock:
+                    changed = self.states.get(device_id) != state
+                    self.states[device_id] = state
+                if changed and state == FAILED:
+                    logger.warning(f"deployment failed on device {device_id} - "
+                                   f"{entry.get('failure_reason') or entry.get('error_message') or 'no reason given'}")
+        counts = self.counts()
+        logger.info("deployment progress: " + ", ".join(f"{count} {name.lower()}" for name, count in counts.items()))
+        if self.metrics is not None:
+            self.metrics.set_deployment_counts(id(self), counts)
+        return counts
+
+    def restart(self, device_ids):
+        # devices pushed again start over
+        with self.lock:
+            for device_id in device_ids:
+                self.states[device_id] = PENDING
+
+    def state(self, device_id):
+        return STATE_NAMES[self.states[device_id]]
+
+    def unfinished(self, device_ids=None):
+        # devices that have not succeeded or failed yet
+        with self.lock:
+            if device_ids is None:
+                device_ids = list(self.states)
+            return [device_id for device_id in device_ids if self.states.get(device_id) in (PENDING, RUNNING)]
+
+    def not_succeeded(self, device_ids=None):
+        # devices that failed or are still pending - the targets of a follow-up push
+        with self.lock:
+            if device_ids is None:
+                device_ids = list(self.states)
+            return [device_id for device_id in device_ids if self.states.get(device_id) != SUCCEEDED]
+
+    def counts(self):
+        with self.lock:
+            counts = dict.fromkeys(STATE_NAMES, 0)
+            for state in self.states.values():
+                counts[STATE_NAMES[state]] += 1
+        return counts
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+# device fields kept from the XIQ /devices response, everything else in the page is dropped
+DEVICE_FIELDS = ('id', 'hostname', 'location_id', 'connected')
+
+
+class Device:
+    # One device from a /devices page. __slots__ keeps each record to a few pointers instead of the
+    # full JSON dict, which matters when a scan holds 100k devices.
+    __slots__ = DEVICE_FIELDS
+
+    def __init__(self, id, hostname=None, location_id=None, connected=None):
+        self.id = id
+        self.hostname = hostname
+        self.location_id = location_id
+        self.connected = connected
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['id'], data.get('hostname'), data.get('location_id'), data.get('connected'))
+
+    def __getitem__(self, field):
+        # device['id'] for code written against the /devices dicts. Fields that are not kept raise KeyError
+        if field not in DEVICE_FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        value = self[field] if field in DEVICE_FIELDS else None
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"Device(id={self.id!r}, hostname={self.hostname!r})"
+
+
+def parse_devices(data):
+    # compact Devices from the 'data' list of a /devices page
+    return [Device.from_json(device) for device in data]
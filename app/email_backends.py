@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import importlib
+import logging
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.email_backends')
+
+# email_type -> "module" or "module:attribute" of the backend class. A backend is only imported when
+# it is selected, so the Google client libraries are not loaded when gmail is not used.
+# Backend classes are built with the yml variables and provide send_message(body, recipients, subject=None)
+EMAIL_BACKENDS = {
+    'gmail': 'app.gmail:new',
+    'smtp': 'app.smtp:new',
+    'disabled': 'app.email_backends:DisabledBackend',
+}
+
+
+class UnknownEmailBackend(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class DisabledBackend:
+    # email_type: disabled - messages are only logged
+    def __init__(self, yml_variables):
+        self.yml_variables = yml_variables
+
+    def send_message(self, body, recipients, subject=None):
+        print("emailing is disabled in yaml variable file. Message will only be logged.")
+        logger.info(f"Email is disabled. Email message: {body}")
+
+
+def register_backend(email_type, target):
+    # adds or replaces a backend, e.g. register_backend('teams', 'my_package.teams:new')
+    EMAIL_BACKENDS[email_type] = target
+
+def load_backend(email_type):
+    # returns the backend class for email_type, importing its module on first use
+    if email_type not in EMAIL_BACKENDS:
+        raise UnknownEmailBackend(f"email_type '{email_type}' is not one of {', '.join(EMAIL_BACKENDS)}")
+    module_name, _, attribute = EMAIL_BACKENDS[email_type].partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attribute or 'new')
+
+def new(email_type, yml_variables):
+    return load_backend(email_type)(yml_variables)
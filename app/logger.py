@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
+import atexit
+import contextvars
+import json
 import logging
 import os
 import inspect
-from logging.handlers import RotatingFileHandler
+import queue
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
@@ -13,13 +19,75 @@ log_formatter = logging.Formatter('%(asctime)s: %(name)s - %(levelname)s - %(mes
 
 logFile = '{}/PSK_rotator_log.log'.format(parent_dir)
 
-my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=50*1024*1024, 
+# fields added to every record. run_id is set once per rotation, the others with log_context()
+CONTEXT_FIELDS = ('run_id', 'ssid', 'endpoint', 'latency')
+run_id = None
+log_fields = contextvars.ContextVar('log_fields', default={})
+
+
+class ContextFilter(logging.Filter):
+    # runs in the thread that logs, so the fields of that thread's context are captured
+    def filter(self, record):
+        fields = log_fields.get()
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field, run_id if field == 'run_id' else None))
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    # one json object per line - log_format: json in variables.yml
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+@contextmanager
+def log_context(**fields):
+    # adds fields (e.g. ssid=...) to every record logged in this context
+    token = log_fields.set({**log_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
+
+def set_run_id(value):
+    global run_id
+    run_id = value
+
+def configure_logging(log_format='text', level=logging.INFO):
+    # log_format 'json' writes JSONFormatter lines, anything else the plain text format
+    my_handler.setFormatter(JSONFormatter() if log_format == 'json' else log_formatter)
+    my_handler.setLevel(level)
+    logger.setLevel(level)
+
+
+my_handler = RotatingFileHandler(logFile, mode='a', maxBytes=50*1024*1024,
                                  backupCount=5, encoding=None, delay=0)
 
 my_handler.setFormatter(log_formatter)
 my_handler.setLevel(logging.INFO)
 
+# loggers only put records on a queue, the file is written by the listener thread
+log_queue = queue.Queue(-1)
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(ContextFilter())
+listener = QueueListener(log_queue, my_handler, respect_handler_level=True)
+listener.start()
+# write out whatever is still queued when the script exits
+atexit.register(listener.stop)
+
 logger = logging.getLogger('root')
 logger.setLevel(logging.INFO)
 
-logger.addHandler(my_handler)
+logger.addHandler(queue_handler)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext, ExitStack
+from urllib.parse import urlparse, parse_qs
+from app.logger import logger
+from app.atomic_file import atomic_write
+logger = logging.getLogger('PSK_Rotator.metrics')
+
+
+def endpoint_name(url):
+    # /ssids/123456/psk/password -> /ssids/{id}/psk/password so calls can be grouped
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlparse(url).path)
+
+def page_number(url):
+    page = parse_qs(urlparse(url).query).get('page')
+    return int(page[0]) if page else None
+
+def stage(metrics, name):
+    # metrics.stage(name) when metrics are being collected, otherwise a no-op context
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+def section(metrics, name):
+    # metrics.section(name) when metrics are being collected, otherwise a no-op context
+    return metrics.section(name) if metrics is not None else nullcontext()
+
+
+class RunMetrics:
+    # Collects a record for every HTTP call to XIQ and a wall clock span for every stage of a run.
+    # write_json() writes a run report and write_prometheus() a node_exporter textfile collector file.
+    def __init__(self, run_id=None):
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.calls = []
+        self.stages = []
+        # latest per device deployment counts of every tracked push, see app.deployment_tracker
+        self.deployments = {}
+        # hook(name, detail) context managers entered around every stage (detail False) and every
+        # section (detail True), e.g. app.profiler.StageProfiler.hook
+        self.stage_hooks = []
+        self.lock = threading.Lock()
+
+    def add_stage_hook(self, hook):
+        self.stage_hooks.append(hook)
+
+    def record_call(self, method, url, status, latency, response_bytes, retry=0):
+        call = {
+            "method": method,
+            "endpoint": endpoint_name(url),
+            "page": page_number(url),
+            "status": status,
+            "latency": round(latency, 6),
+            "bytes": response_bytes,
+            "retry": retry,
+        }
+        with self.lock:
+            self.calls.append(call)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        started_at = time.time()
+        try:
+            with self.__hooks(name, False):
+                yield
+        finally:
+            span = {"stage": name, "started_at": started_at, "seconds": round(time.perf_counter() - start, 6)}
+            with self.lock:
+                self.stages.append(span)
+            logger.info(f"stage {name} took {span['seconds']:.3f} seconds")
+
+    @contextmanager
+    def section(self, name):
+        # a part of a stage that runs too often to be recorded (one XIQ call, one json decode).
+        # Only the stage hooks see it
+        if not self.stage_hooks:
+            yield
+            return
+        with self.__hooks(name, True):
+            yield
+
+    def __hooks(self, name, detail):
+        stack = ExitStack()
+        for hook in self.stage_hooks:
+            stack.enter_context(hook(name, detail))
+        return stack
+
+    def set_deployment_counts(self, push_id, counts):
+        with self.lock:
+            self.deployments[push_id] = dict(counts)
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+            stages = list(self.stages)
+            deployments = {}
+            for counts in self.deployments.values():
+                for state, count in counts.items():
+                    deployments[state] = deployments.get(state, 0) + count
+        endpoints = {}
+        for call in calls:
+            key = f"{call['method']} {call['endpoint']}"
+            entry = endpoints.setdefault(key, {"calls": 0, "retries": 0, "seconds": 0.0, "bytes": 0, "statuses": {}})
+            entry["calls"] += 1
+            entry["retries"] += 1 if call["retry"] else 0
+            entry["seconds"] = round(entry["seconds"] + call["latency"], 6)
+            entry["bytes"] += call["bytes"]
+            status = str(call["status"])
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+        stage_totals = {}
+        for span in stages:
+            stage_totals[span["stage"]] = round(stage_totals.get(span["stage"], 0) + span["seconds"], 6)
+        return {
+            "run_id": self.run_id,
+            "started_at": self.started_at,
+            "wall_seconds": round(time.perf_counter() - self.start, 6),
+            "api_calls": len(calls),
+            "endpoints": endpoints,
+            "stages": stage_totals,
+            "deployment_devices": deployments,
+            "stage_spans": stages,
+            "calls": calls,
+        }
+
+    def write_json(self, path):
+        atomic_write(path, json.dumps(self.summary(), indent=2))
+        logger.info(f"run report written to {path}")
+
+    def write_prometheus(self, path):
+        summary = self.summary()
+        lines = [
+            "# HELP psk_rotator_run_seconds Wall clock time of the last PSK rotation run.",
+            "# TYPE psk_rotator_run_seconds gauge",
+            f"psk_rotator_run_seconds {summary['wall_seconds']}",
+            "# HELP psk_rotator_last_run_timestamp_seconds Start time of the last PSK rotation run.",
+            "# TYPE psk_rotator_last_run_timestamp_seconds gauge",
+            f"psk_rotator_last_run_timestamp_seconds {summary['started_at']}",
+            "# HELP psk_rotator_stage_seconds Wall clock time spent in each stage of the last run.",
+            "# TYPE psk_rotator_stage_seconds gauge",
+        ]
+        for stage_name, seconds in summary["stages"].items():
+            lines.append(f'psk_rotator_stage_seconds{{stage="{stage_name}"}} {seconds}')
+        lines += [
+            "# HELP psk_rotator_api_calls HTTP calls made to XIQ in the last run.",
+            "# TYPE psk_rotator_api_calls gauge",
+        ]
+        for key, entry in summary["endpoints"].items():
+            method, endpoint = key.split(" ", 1)
+            for status, count in entry["statuses"].items():
+                lines.append(f'psk_rotator_api_calls{{method="{method}",endpoint="{endpoint}",status="{status}"}} {count}')
+        for name, field, help_text in (
+                ("psk_rotator_api_call_seconds", "seconds", "Time spent waiting on XIQ calls in the last run."),
+                ("psk_rotator_api_response_bytes", "bytes", "Response bytes received from XIQ in the last run."),
+                ("psk_rotator_api_retries", "retries", "Retried XIQ calls in the last run.")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for key, entry in summary["endpoints"].items():
+                method, endpoint = key.split(" ", 1)
+                lines.append(f'{name}{{method="{method}",endpoint="{endpoint}"}} {entry[field]}')
+        if summary["deployment_devices"]:
+            lines += [
+                "# HELP psk_rotator_deployment_devices Devices of the last run's config push by deployment state.",
+                "# TYPE psk_rotator_deployment_devices gauge",
+            ]
+            for state, count in summary["deployment_devices"].items():
+                lines.append(f'psk_rotator_deployment_devices{{state="{state}"}} {count}')
+        atomic_write(path, "\n".join(lines) + "\n")
+        logger.info(f"prometheus metrics written to {path}")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import logging
+import time
+from app.logger import logger
+from app.poller import Poller
+logger = logging.getLogger('PSK_Rotator.mismatch_tracker')
+
+
+class MismatchTracker:
+    # Finds the devices that became mismatched because of the PSK change.
+    #   baseline - devices that were already mismatched before the change (pre-existing drift)
+    #   induced  - devices that became mismatched after the change
+    # After the change the mismatched devices are polled and diffed against what was seen before. The
+    # wait ends once new devices have appeared and no more were added for quiet_period seconds, or at
+    # timeout. With location_ids each poll scans the locations concurrently and every device keeps
+    # the location it was found in, so the push can be staged site by site.
+    def __init__(self, x, quiet_period=15, timeout=300, location_ids=None, workers=4):
+        self.x = x
+        self.quiet_period = quiet_period
+        self.timeout = timeout
+        self.location_ids = location_ids
+        self.workers = workers
+        # checks speed up to at least two per quiet period
+        self.poller = Poller(initial_interval=x.poller.initial_interval,
+                             max_interval=max(x.poller.initial_interval, min(x.poller.max_interval, quiet_period / 2)))
+        self.baseline = {}
+        self.induced = {}
+        self.current = {}
+        self.last_growth = None
+
+    def scan(self):
+        # {device id: location id (None without locations)} of the currently mismatched devices
+        if self.location_ids:
+            devices_by_location = self.x.scan_locations(self.location_ids, workers=self.workers, fields=("ID",))
+            return {device.id: location_id for location_id, devices in devices_by_location.items()
+                    for device in devices}
+        return {device.id: None for device in self.x.iter_mismatch_devices(fields=["ID"])}
+
+    def snapshot(self, devices=None):
+        # records the pre-change state. devices is an earlier scan (Devices, or a scan() result)
+        # so the pre-check scan does not have to be repeated
+        if devices is None:
+            self.baseline = self.scan()
+        elif isinstance(devices, dict):
+            self.baseline = dict(devices)
+        else:
+            self.baseline = {device.id: None for device in devices}
+        if self.baseline:
+            logger.info(f"{len(self.baseline)} devices were already mismatched before the PSK change")
+        return self.baseline
+
+    def __update(self):
+        self.current = self.scan()
+        new_devices = {device_id: location_id for device_id, location_id in self.current.items()
+                       if device_id not in self.baseline and device_id not in self.induced}
+        if new_devices:
+            self.induced.update(new_devices)
+            self.last_growth = time.monotonic()
+            logger.info(f"{len(new_devices)} newly mismatched devices, {len(self.induced)} since the PSK change")
+        return self.current
+
+    def __converged(self, current):
+        return bool(self.induced) and time.monotonic() - self.last_growth >= self.quiet_period
+
+    def wait(self):
+        # polls until converged or timeout. Returns the induced devices that are still mismatched
+        print(f"Waiting up to {self.timeout} seconds for mismatched devices to stop growing for {self.quiet_period} seconds")
+        current, converged = self.poller.poll(self.__update, self.__converged, self.timeout,
+                                              info="wait for mismatched devices to converge")
+        if not converged and self.induced:
+            logger.warning(f"mismatched devices were still being added after {self.timeout} seconds")
+        return self.pending()
+
+    def pending(self):
+        # induced devices that are mismatched in the last scan - the delta that needs a push
+        return {device_id: location_id for device_id, location_id in self.induced.items()
+                if device_id in self.current}
+
+    def preexisting(self):
+        # devices that were mismatched before the change and still are
+        return {device_id: location_id for device_id, location_id in self.baseline.items()
+                if device_id in self.current}
+
+
+def group_by_location(devices, location_ids):
+    # {device id: location id} -> {location id: [device ids]} in location_ids order
+    devices_by_location = {location_id: [] for location_id in location_ids}
+    for device_id, location_id in devices.items():
+        devices_by_location.setdefault(location_id, []).append(device_id)
+    return devices_by_location
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import logging
+import queue
+import random
+import threading
+import time
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.notifier')
+
+
+class Notifier:
+    # Sends messages on a background thread so emails go out while the rotation carries on.
+    # deliver(body, recipients, subject) does the actual send and raises on failure. A failed
+    # message is tried again up to max_attempts times with a growing random delay, then it is
+    # logged in full and kept in failed.
+    def __init__(self, deliver, max_attempts=3, base_delay=2, max_delay=30):
+        self.deliver = deliver
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.failed = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, body, recipients, subject=None):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name="notifier", daemon=True)
+                self.thread.start()
+        self.queue.put((body, recipients, subject))
+
+    def __run(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if message is None:
+                    return
+                self.__send(*message)
+            finally:
+                self.queue.task_done()
+
+    def __send(self, body, recipients, subject):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.deliver(body, recipients, subject)
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    logger.error(f"Failed to send email to {', '.join(recipients)} after {attempt} attempts - {e}\n"
+                                 f"Subject: {subject}\n{body}")
+                    self.failed.append((body, recipients, subject))
+                    return
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                logger.warning(f"Failed to send email to {', '.join(recipients)} - {e}. Trying again in {delay:.1f} seconds")
+                time.sleep(delay)
+
+    def flush(self):
+        # waits until every submitted message was sent or given up on
+        self.queue.join()
+
+    def close(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
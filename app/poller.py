@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import random
+import time
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.poller')
+
+
+class Poller:
+    # Calls a check function until it reports done. Starts with short intervals and backs off
+    # exponentially (with jitter) up to max_interval, giving up once the deadline has passed.
+    def __init__(self, initial_interval=2, max_interval=30, factor=2, jitter=0.2):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+
+    def intervals(self):
+        interval = self.initial_interval
+        while True:
+            spread = interval * self.jitter
+            yield max(0, interval + random.uniform(-spread, spread))
+            interval = min(interval * self.factor, self.max_interval)
+
+    def poll(self, check, is_done, deadline, info="poll"):
+        # returns (last result, True if is_done was reached before the deadline)
+        end_time = time.monotonic() + deadline
+        intervals = self.intervals()
+        attempt = 1
+        while True:
+            result = check()
+            if is_done(result):
+                logger.info(f"{info} completed after {attempt} checks")
+                return result, True
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"{info} did not complete within {deadline} seconds")
+                return result, False
+            sleep_time = min(next(intervals), remaining)
+            logger.info(f"{info} not complete after check {attempt}, checking again in {sleep_time:.1f} seconds")
+            time.sleep(sleep_time)
+            attempt += 1
+
+    async def poll_async(self, check, is_done, deadline, info="poll"):
+        # same as poll() but check is a coroutine function and the waits do not block the event loop
+        end_time = time.monotonic() + deadline
+        intervals = self.intervals()
+        attempt = 1
+        while True:
+            result = await check()
+            if is_done(result):
+                logger.info(f"{info} completed after {attempt} checks")
+                return result, True
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"{info} did not complete within {deadline} seconds")
+                return result, False
+            sleep_time = min(next(intervals), remaining)
+            logger.info(f"{info} not complete after check {attempt}, checking again in {sleep_time:.1f} seconds")
+            await asyncio.sleep(sleep_time)
+            attempt += 1
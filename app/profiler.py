@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.profiler')
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+
+
+class StageProfiler:
+    # --profile: a sampling profiler and tracemalloc driven by the RunMetrics stage hooks.
+    # A sampler thread reads the stack of every thread each interval seconds and counts it under the
+    # innermost stage or section that thread is in - threads outside any stage are not counted. A sample
+    # shows where the time went whether the thread was busy or waiting (socket reads, lock waits), the
+    # cpu time of each stage is measured with thread_time to tell the two apart. Stages (not sections)
+    # also get a tracemalloc snapshot diff. Snapshots see every thread, so stages that overlap share
+    # their allocations.
+    def __init__(self, interval=0.005, top_n=15, memory=True, memory_frames=1):
+        self.interval = interval
+        self.top_n = top_n
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self.lock = threading.Lock()
+        # thread id -> stages and sections the thread is in, innermost last
+        self.active = {}
+        # stage name -> {'calls', 'seconds', 'cpu_seconds', 'allocated', 'samples': Counter of stacks, 'allocations': Counter}
+        self.stages = {}
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.started = None
+        self.seconds = 0
+        self.final_snapshot = None
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self.__sample_loop, name="stage-profiler", daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        self.seconds = time.perf_counter() - self.started
+        if self.memory and tracemalloc.is_tracing():
+            self.final_snapshot = self.__snapshot()
+            tracemalloc.stop()
+
+    def __stats(self, name):
+        # called with self.lock held
+        return self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'allocated': 0,
+                                             'samples': Counter(), 'allocations': Counter()})
+
+    @contextmanager
+    def hook(self, name, detail):
+        # RunMetrics stage hook
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.active.setdefault(thread_id, []).append(name)
+        snapshot = self.__snapshot() if self.memory and not detail and tracemalloc.is_tracing() else None
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.thread_time() - cpu_start
+            allocations = []
+            if snapshot is not None and tracemalloc.is_tracing():
+                allocations = self.__snapshot().compare_to(snapshot, 'lineno')
+            with self.lock:
+                stack = self.active[thread_id]
+                # async code can leave stages of one thread out of order
+                del stack[len(stack) - 1 - stack[::-1].index(name)]
+                if not stack:
+                    del self.active[thread_id]
+                stats = self.__stats(name)
+                stats['calls'] += 1
+                stats['seconds'] += seconds
+                stats['cpu_seconds'] += cpu_seconds
+                for difference in allocations:
+                    if difference.size_diff > 0 and not self.__own(difference.traceback[0].filename):
+                        stats['allocated'] += difference.size_diff
+                        stats['allocations'][str(difference.traceback[0])] += difference.size_diff
+
+    def __snapshot(self):
+        return tracemalloc.take_snapshot()
+
+    def __own(self, filename):
+        # allocations and samples of tracemalloc and this module are left out
+        return filename in (tracemalloc.__file__, __file__)
+
+    def __sample_loop(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                active = {thread_id: stack[-1] for thread_id, stack in self.active.items() if stack}
+            samples = []
+            for thread_id, name in active.items():
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    if self.__own(frame.f_code.co_filename):
+                        # the thread is taking a snapshot for this profiler
+                        break
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                else:
+                    samples.append((name, tuple(reversed(stack))))
+            del frames
+            with self.lock:
+                for name, stack in samples:
+                    self.__stats(name)['samples'][stack] += 1
+
+    def summary(self):
+        # the top_n hot spots of every stage as text
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1]['seconds'], reverse=True)
+        lines = [f"PSK rotator profile - {self.seconds:.3f} seconds, one sample every {self.interval * 1000:g} ms",
+                 "",
+                 f"{'stage / section':<40} {'calls':>7} {'wall s':>10} {'cpu s':>10} {'wait s':>10} {'samples':>8} {'alloc KiB':>10}"]
+        for name, stats in stages:
+            lines.append(f"{name[:40]:<40} {stats['calls']:>7} {stats['seconds']:>10.3f} {stats['cpu_seconds']:>10.3f} "
+                         f"{max(0.0, stats['seconds'] - stats['cpu_seconds']):>10.3f} {sum(stats['samples'].values()):>8} "
+                         f"{stats['allocated'] / 1024:>10.1f}")
+        for name, stats in stages:
+            total = sum(stats['samples'].values())
+            if not total and not stats['allocations']:
+                continue
+            lines += ["", f"== {name}"]
+            if total:
+                # self samples - the frame that was running (or waiting) when the sample was taken
+                leaves = Counter()
+                for stack, count in stats['samples'].items():
+                    leaves[stack[-1]] += count
+                lines.append(f"  top frames ({total} samples)")
+                for label, count in leaves.most_common(self.top_n):
+                    lines.append(f"    {count / total:>6.1%}  {label}")
+            if stats['allocations']:
+                lines.append("  top allocations")
+                for label, size in stats['allocations'].most_common(self.top_n):
+                    lines.append(f"    {size / 1024:>10.1f} KiB  {label}")
+        if self.final_snapshot is not None:
+            lines += ["", "== memory still allocated at the end of the run"]
+            statistics = [statistic for statistic in self.final_snapshot.statistics('lineno')
+                          if not self.__own(statistic.traceback[0].filename)]
+            for statistic in statistics[:self.top_n]:
+                lines.append(f"    {statistic.size / 1024:>10.1f} KiB  {statistic.traceback[0]} ({statistic.count} blocks)")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory, name="PSK_rotator_profile"):
+        # name.txt has the summary, name.folded the sampled stacks per stage in the collapsed stack
+        # format read by flamegraph.pl and speedscope. Returns the summary path
+        summary_path = os.path.join(directory, f"{name}.txt")
+        with open(summary_path, 'w') as f:
+            f.write(self.summary())
+        with self.lock:
+            stages = {stage_name: dict(stats['samples']) for stage_name, stats in self.stages.items()}
+        with open(os.path.join(directory, f"{name}.folded"), 'w') as f:
+            for stage_name, samples in stages.items():
+                for stack, count in samples.items():
+                    f.write(";".join((stage_name,) + stack) + f" {count}\n")
+        logger.info(f"profile written to {summary_path}")
+        return summary_path
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import math
+import os
+import secrets
+import string
+import threading
+from app.logger import logger
+from app.atomic_file import atomic_write
+logger = logging.getLogger('PSK_Rotator.psk_generator')
+
+# characters that are easy to misread when a PSK is typed from an email
+AMBIGUOUS = set("Il1O0o")
+SYMBOLS = "!#$%&*+-=?@^_~"
+
+
+class PSKPolicy:
+    # What generated PSKs look like. With a wordlist, PSKs are passphrases of 'words' random words,
+    # otherwise random characters from the enabled classes with at least one of each class.
+    def __init__(self, length=16, lowercase=True, uppercase=True, digits=True, symbols=False,
+                 exclude_ambiguous=True, wordlist=None, words=4, separator="-"):
+        self.length = length
+        self.words = words
+        self.separator = separator
+        self.classes = []
+        for enabled, characters in ((lowercase, string.ascii_lowercase), (uppercase, string.ascii_uppercase),
+                                    (digits, string.digits), (symbols, SYMBOLS)):
+            if enabled:
+                if exclude_ambiguous:
+                    characters = "".join(c for c in characters if c not in AMBIGUOUS)
+                self.classes.append(characters)
+        self.wordlist = None
+        if wordlist:
+            with open(wordlist, 'r') as f:
+                self.wordlist = sorted({line.strip() for line in f if line.strip()})
+            if not self.wordlist:
+                raise ValueError(f"psk_generator wordlist {wordlist} has no words")
+            if not isinstance(words, int) or words < 1:
+                raise ValueError("psk_generator words must be at least 1")
+            # WPA PSKs are 8 to 63 characters, some passphrases must fall in between
+            separators = (words - 1) * len(separator)
+            if words * max(len(word) for word in self.wordlist) + separators < 8:
+                raise ValueError(f"psk_generator passphrases of {words} words from {wordlist} are shorter than 8 characters, use more words")
+            if words * min(len(word) for word in self.wordlist) + separators > 63:
+                raise ValueError(f"psk_generator passphrases of {words} words from {wordlist} are longer than 63 characters, use fewer words")
+            if len(self.wordlist) < 1000:
+                logger.warning(f"wordlist {wordlist} only has {len(self.wordlist)} words, passphrases will be weak")
+        elif not self.classes:
+            raise ValueError("psk_generator needs at least one character class or a wordlist")
+        elif not max(8, len(self.classes)) <= length <= 63:
+            # WPA PSKs are 8 to 63 characters
+            raise ValueError(f"psk_generator length must be between {max(8, len(self.classes))} and 63")
+
+    @classmethod
+    def from_variables(cls, settings):
+        return cls(length=settings.get('length', 16), lowercase=settings.get('lowercase', True),
+                   uppercase=settings.get('uppercase', True), digits=settings.get('digits', True),
+                   symbols=settings.get('symbols', False), exclude_ambiguous=settings.get('exclude_ambiguous', True),
+                   wordlist=settings.get('wordlist') or None, words=settings.get('words', 4),
+                   separator=settings.get('separator', "-"))
+
+
+class PSKGenerator:
+    # makes PSKs with the secrets module (the OS CSPRNG)
+    def __init__(self, policy):
+        self.policy = policy
+
+    def generate(self):
+        policy = self.policy
+        if policy.wordlist:
+            while True:
+                psk = policy.separator.join(secrets.choice(policy.wordlist) for _ in range(policy.words))
+                # passphrases outside the WPA 8 to 63 characters are drawn again
+                if 8 <= len(psk) <= 63:
+                    return psk
+        # one character from every class, the rest from all of them, then shuffled
+        alphabet = "".join(policy.classes)
+        characters = [secrets.choice(characters) for characters in policy.classes]
+        characters += [secrets.choice(alphabet) for _ in range(policy.length - len(characters))]
+        secrets.SystemRandom().shuffle(characters)
+        return "".join(characters)
+
+    def generate_batch(self, count, history=None, max_attempts=None):
+        # returns up to count new PSKs that are not in history (and not repeated in the batch)
+        batch = []
+        seen = set()
+        attempts = 0
+        max_attempts = max_attempts or count * 10
+        while len(batch) < count and attempts < max_attempts:
+            attempts += 1
+            psk = self.generate()
+            if psk in seen or (history is not None and history.seen(psk)):
+                continue
+            seen.add(psk)
+            batch.append(psk)
+        if len(batch) < count:
+            logger.warning(f"only {len(batch)} of {count} PSKs could be generated without repeating an earlier PSK")
+        return batch
+
+
+class BloomFilter:
+    # Fixed size set membership with a small chance of false positives and no false negatives.
+    # Sized from capacity and error_rate: 1 million PSKs at 1 in a million takes about 3.6MB.
+    def __init__(self, capacity=1000000, error_rate=1e-6, salt=None, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.salt = salt if salt is not None else secrets.token_bytes(16)
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __indexes(self, value):
+        # k indexes from two halves of one salted sha256 (double hashing)
+        digest = hashlib.sha256(self.salt + value.encode()).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, value):
+        for index in self.__indexes(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self.__indexes(value))
+
+
+class PSKHistory:
+    # Every PSK that was generated or used, kept as a salted Bloom filter on disk so the PSKs themselves
+    # are never stored. Checking a candidate is O(1) and the file size does not grow with use.
+    def __init__(self, path, capacity=1000000, error_rate=1e-6):
+        self.path = path
+        self.lock = threading.Lock()
+        self.bloom = self.__load() if path and os.path.exists(path) else BloomFilter(capacity, error_rate)
+        if self.bloom.count > self.bloom.capacity:
+            logger.warning(f"PSK history {path} holds more PSKs than its capacity, false matches will increase")
+
+    def __load(self):
+        with open(self.path, 'rb') as f:
+            header = json.loads(f.readline())
+            bloom = BloomFilter(header['capacity'], header['error_rate'], bytes.fromhex(header['salt']),
+                                bytearray(f.read()))
+        bloom.count = header['count']
+        return bloom
+
+    def seen(self, psk):
+        with self.lock:
+            return psk in self.bloom
+
+    def add(self, psks):
+        with self.lock:
+            for psk in psks:
+                if psk not in self.bloom:
+                    self.bloom.add(psk)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            header = {'capacity': self.bloom.capacity, 'error_rate': self.bloom.error_rate,
+                      'salt': self.bloom.salt.hex(), 'count': self.bloom.count}
+            atomic_write(self.path, json.dumps(header).encode() + b"\n" + bytes(self.bloom.bits), file_mode=0o600)
+
+
+def refill(store, ssid_id, generator, history, low_water=10, batch_size=100):
+    # tops up the store for an SSID when fewer than low_water PSKs are left. Returns the number added
+    available = store.available(ssid_id)
+    if available >= low_water:
+        return 0
+    batch = generator.generate_batch(batch_size, history)
+    added = store.add(ssid_id, batch)
+    history.add(batch)
+    try:
+        history.save()
+    except OSError as e:
+        # the new PSKs are already in the store, the history is saved again at the end of the run
+        logger.error(f"Failed to save the PSK history {history.path} - {e}")
+    logger.info(f"generated {added} new PSKs for SSID {ssid_id}, {available} were left")
+    return added
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import logging
+import os
+import io
+import sqlite3
+import threading
+import time
+from collections import Counter
+from app.logger import logger
+from app.atomic_file import atomic_write
+logger = logging.getLogger('PSK_Rotator.psk_store')
+
+
+class PSKStoreError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class Reservation:
+    # a PSK taken from a store for one SSID. It is only removed from the pool by commit()
+    def __init__(self, ssid_id, psk, key=None):
+        self.ssid_id = ssid_id
+        self.psk = psk
+        self.key = key
+
+
+class CSVStore:
+    # The original one PSK per line csv file. The next PSK is the first line that is not reserved. The
+    # file is rewritten (to a temp file that then replaces it, so a crash can not leave it half written)
+    # on commit. SSIDs that share the file share the store, so PSKs reserved by one SSID are skipped
+    # until they are committed or rolled back.
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        # PSKs reserved and not yet committed or rolled back, a PSK may be in the file more than once
+        self.reserved = Counter()
+
+    def __read(self):
+        if not os.path.exists(self.file_name):
+            raise PSKStoreError(f"File {self.file_name} does not exist. Please check variables.yml")
+        with open(self.file_name, 'r') as csv_f:
+            return [row for row in csv.reader(csv_f) if row]
+
+    def reserve(self, ssid_id):
+        with self.lock:
+            skip = Counter(self.reserved)
+            for row in self.__read():
+                if skip[row[0]]:
+                    skip[row[0]] -= 1
+                    continue
+                self.reserved[row[0]] += 1
+                return Reservation(ssid_id, row[0])
+        return None
+
+    def __release(self, reservation):
+        # called with self.lock held
+        if self.reserved[reservation.psk] > 1:
+            self.reserved[reservation.psk] -= 1
+        else:
+            self.reserved.pop(reservation.psk, None)
+
+    def commit(self, reservation, reuse=False):
+        with self.lock:
+            self.__release(reservation)
+            rows = self.__read()
+            index = next((index for index, row in enumerate(rows) if row[0] == reservation.psk), None)
+            if index is None:
+                logger.warning(f"PSK for SSID {reservation.ssid_id} is no longer in {self.file_name}, the file is not changed")
+                return
+            rows.pop(index)
+            # add psk to end of list if reuse_psks is True
+            if reuse:
+                rows.append([reservation.psk])
+            atomic_write_csv(rows, self.file_name)
+
+    def rollback(self, reservation):
+        # the PSK stays in the file and can be reserved again
+        with self.lock:
+            self.__release(reservation)
+
+    def available(self, ssid_id):
+        with self.lock:
+            if not os.path.exists(self.file_name):
+                return 0
+            return len(self.__read()) - sum(self.reserved.values())
+
+    def add(self, ssid_id, psks):
+        # adds PSKs at the end of the file, returns how many were added
+        with self.lock:
+            rows = self.__read() if os.path.exists(self.file_name) else []
+            new_rows = [[psk] for psk in psks]
+            atomic_write_csv(rows + new_rows, self.file_name)
+        return len(new_rows)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    # PSK pools for any number of SSIDs in one SQLite database. Taking the next PSK is an indexed lookup
+    # so it does not depend on the pool size, and every change is a single transaction.
+    #   available -> reserved (reserve) -> used (commit) or back to available (rollback)
+    # With reuse, a committed PSK is added again at the end of the pool.
+    def __init__(self, db_path, stale_reservation_time=3600):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS psks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ssid_id TEXT NOT NULL,
+                psk TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'available',
+                reserved_at REAL,
+                used_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS psks_next ON psks (ssid_id, state, id);
+        """)
+        self.__release_stale(stale_reservation_time)
+
+    def __release_stale(self, stale_reservation_time):
+        # a reservation left behind by a crash may already be set in XIQ, so it is not handed out again
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE psks SET state = 'used', used_at = ? WHERE state = 'reserved' AND reserved_at < ?",
+                (time.time(), time.time() - stale_reservation_time))
+        if cursor.rowcount:
+            logger.warning(f"{cursor.rowcount} PSKs reserved by an earlier run that did not finish were marked as used")
+
+    def reserve(self, ssid_id):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT id, psk FROM psks WHERE ssid_id = ? AND state = 'available' ORDER BY id LIMIT 1",
+                    (str(ssid_id),)).fetchone()
+                if row is None:
+                    self.connection.execute("COMMIT")
+                    return None
+                self.connection.execute("UPDATE psks SET state = 'reserved', reserved_at = ? WHERE id = ?",
+                                        (time.time(), row[0]))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return Reservation(ssid_id, row[1], row[0])
+
+    def commit(self, reservation, reuse=False):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("UPDATE psks SET state = 'used', used_at = ? WHERE id = ?",
+                                        (time.time(), reservation.key))
+                if reuse:
+                    self.connection.execute("INSERT INTO psks (ssid_id, psk) VALUES (?, ?)",
+                                            (str(reservation.ssid_id), reservation.psk))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def rollback(self, reservation):
+        # the PSK keeps its place at the front of the pool
+        with self.lock:
+            self.connection.execute("UPDATE psks SET state = 'available', reserved_at = NULL WHERE id = ?",
+                                    (reservation.key,))
+
+    def available(self, ssid_id):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM psks WHERE ssid_id = ? AND state = 'available'",
+                                           (str(ssid_id),)).fetchone()[0]
+
+    def known(self, ssid_id):
+        # True if PSKs were ever added for the SSID
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM psks WHERE ssid_id = ? LIMIT 1",
+                                           (str(ssid_id),)).fetchone() is not None
+
+    def add(self, ssid_id, psks):
+        # adds PSKs at the end of the pool in one transaction, returns how many were added
+        count = 0
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for psk in psks:
+                    self.connection.execute("INSERT INTO psks (ssid_id, psk) VALUES (?, ?)", (str(ssid_id), psk))
+                    count += 1
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return count
+
+    def import_csv(self, ssid_id, file_name):
+        # streams the csv file into the pool - the file itself is left unchanged
+        with open(file_name, 'r') as csv_f:
+            count = self.add(ssid_id, (row[0] for row in csv.reader(csv_f) if row))
+        logger.info(f"imported {count} PSKs for SSID {ssid_id} from {file_name}")
+        return count
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def atomic_write_csv(rows, output_file):
+    # the csv is either old or new, and keeps its permissions
+    text = io.StringIO(newline='')
+    csv.writer(text).writerows(rows)
+    atomic_write(output_file, text.getvalue())
+
+
+if __name__ == '__main__':
+    # import a PSK csv file into a SQLite store:
+    #   python -m app.psk_store --db psk_store.db --ssid 123456 --csv psk_list.csv
+    parser = argparse.ArgumentParser(description="Import a PSK csv file into the SQLite PSK store")
+    parser.add_argument('--db', required=True, help="path of the SQLite database (created if missing)")
+    parser.add_argument('--ssid', required=True, help="SSID_ID the PSKs belong to")
+    parser.add_argument('--csv', required=True, help="csv file with one PSK per line")
+    args = parser.parse_args()
+    store = SQLiteStore(args.db)
+    count = store.import_csv(args.ssid, args.csv)
+    print(f"Imported {count} PSKs, {store.available(args.ssid)} available for SSID {args.ssid}")
+    store.close()
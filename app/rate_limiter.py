@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.rate_limiter')
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date. Returns seconds or None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _header_number(headers, *names):
+    # rate limit headers look like "7500" or "7500;w=3600" - returns the leading number of the first one found
+    for name in names:
+        value = headers.get(name)
+        if value:
+            try:
+                return float(str(value).split(';')[0].split(',')[0].strip())
+            except ValueError:
+                continue
+    return None
+
+
+class RateLimiter:
+    # Token bucket shared by every call made through an XIQ instance, including concurrent page fetches.
+    # The rate follows what XIQ reports: it is halved on a 429, lowered to what the remaining quota allows
+    # from the rate limit headers, and slowly raised back towards max_rate while calls succeed.
+    def __init__(self, max_rate=10, burst=10, min_rate=0.2):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def __refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        # takes a token and returns how many seconds the caller has to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.__refill(now)
+            self.tokens -= 1
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, status_code, headers):
+        # adjusts the rate from a response
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        remaining = _header_number(headers, 'RateLimit-Remaining', 'X-RateLimit-Remaining')
+        reset = _header_number(headers, 'RateLimit-Reset', 'X-RateLimit-Reset')
+        with self.lock:
+            now = time.monotonic()
+            self.__refill(now)
+            if status_code == 429:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+                pause = retry_after if retry_after is not None else 1 / self.rate
+                self.paused_until = max(self.paused_until, now + pause)
+                logger.warning(f"XIQ rate limit hit, pausing calls for {pause:.1f} seconds and lowering rate to {self.rate:.2f}/s")
+                return
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            if remaining is not None and reset is not None:
+                # reset may be a epoch timestamp or seconds until the window resets
+                if reset > 10 ** 9:
+                    reset = reset - time.time()
+                allowed = remaining / max(reset, 1)
+                if allowed < self.rate:
+                    self.rate = max(self.min_rate, allowed)
+                    logger.info(f"lowering XIQ call rate to {self.rate:.2f}/s, {int(remaining)} calls left in the current window")
+                    return
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
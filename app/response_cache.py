@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
+from app.logger import logger
+from app.metrics import endpoint_name
+logger = logging.getLogger('PSK_Rotator.response_cache')
+
+
+def cache_key(url):
+    # the same request with its query parameters in a different order is one entry
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(query=urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))))
+
+
+class ResponseCache:
+    # GET responses kept for ttls[endpoint] seconds, e.g. {"/devices": 5}. Endpoints without a ttl are
+    # not cached. Once an entry is older than its ttl (or invalidated) it is kept for a conditional
+    # request: if XIQ sent an ETag or Last-Modified header, the next GET sends If-None-Match or
+    # If-Modified-Since and a 304 answer reuses the cached data. The least recently used entries are
+    # dropped above max_entries.
+    def __init__(self, ttls=None, max_entries=256):
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+
+    def cacheable(self, url):
+        return endpoint_name(url) in self.ttls
+
+    def get(self, url):
+        # the cached data if it is still fresh, otherwise None
+        key = cache_key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() >= entry['expires_at']:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['data']
+
+    def validators(self, url):
+        # conditional request headers for a stale entry
+        with self.lock:
+            entry = self.entries.get(cache_key(url))
+            if entry is None:
+                return {}
+            headers = {}
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+    def store(self, url, data, headers):
+        if not self.cacheable(url):
+            return
+        key = cache_key(url)
+        with self.lock:
+            self.entries[key] = {'data': data, 'expires_at': time.monotonic() + self.ttls[endpoint_name(url)],
+                                 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def not_modified(self, url):
+        # XIQ answered 304 - the cached data is fresh again. None if the entry was evicted meanwhile
+        key = cache_key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry['expires_at'] = time.monotonic() + self.ttls.get(endpoint_name(url), 0)
+            self.entries.move_to_end(key)
+            self.revalidated += 1
+            return entry['data']
+
+    def invalidate(self, endpoint=None):
+        # makes the entries of endpoint (default all) stale, they are only used again after a 304
+        with self.lock:
+            for key, entry in self.entries.items():
+                if endpoint is None or endpoint_name(key) == endpoint:
+                    entry['expires_at'] = 0
+        logger.info(f"response cache invalidated for {endpoint or 'all endpoints'}")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import logging
+import random
+import threading
+import time
+from app.logger import logger
+logger = logging.getLogger('PSK_Rotator.retry')
+
+# HTTP status codes worth trying again. Other 4xx errors will fail the same way every time
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class CircuitBreaker:
+    # Stops calls to XIQ for reset_timeout seconds after failure_threshold failures in a row.
+    # Once the timeout passes a single trial call is let through - if it works the circuit closes again.
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                logger.info("circuit breaker is half open, trying a single call to XIQ")
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("circuit breaker closed, XIQ is responding again")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_other(self):
+        # an error that says nothing about XIQ's health (429, other 4xx) leaves the failure count alone.
+        # If it was the half open trial call, the next trial is made after another reset_timeout
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error(f"circuit breaker opened after {self.failures} failures in a row, "
+                                 f"calls to XIQ are paused for {self.reset_timeout} seconds")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    # Decides if and when a failed API call is tried again. Delays grow exponentially with full
+    # jitter up to max_delay. A run gets at most retry_budget retries in total and no retry is
+    # started once deadline seconds have passed since start().
+    def __init__(self, max_attempts=5, base_delay=1, max_delay=30, retry_budget=50, deadline=900,
+                 retry_status_codes=RETRY_STATUS_CODES, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_budget = retry_budget
+        self.deadline = deadline
+        self.retry_status_codes = retry_status_codes
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        # resets the budget and deadline for a new run
+        with self.lock:
+            self.retries_left = self.retry_budget
+            self.started_at = time.monotonic()
+
+    def is_retryable(self, error):
+        # errors with a status_code came back from XIQ, anything else (timeouts, dropped connections,
+        # unreadable responses) is treated as a transient problem
+        status_code = getattr(error, 'status_code', None)
+        if status_code is None:
+            return isinstance(error, ValueError)
+        return status_code in self.retry_status_codes
+
+    def is_outage(self, error):
+        # failures that say XIQ itself is unhealthy and count against the circuit breaker
+        status_code = getattr(error, 'status_code', None)
+        if status_code is None:
+            return isinstance(error, ValueError)
+        return status_code >= 500
+
+    def allow(self):
+        # False while the circuit breaker is open
+        return self.breaker.allow()
+
+    def on_success(self):
+        self.breaker.record_success()
+
+    def on_error(self, attempt, error, info="call XIQ", endpoint=None):
+        # the bookkeeping for a failed attempt of both XIQ clients: counts outages against the circuit
+        # breaker and returns the seconds to wait before the next attempt, or None (logged) to give up
+        if self.is_outage(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_other()
+        delay = self.next_delay(attempt, error)
+        if delay is None:
+            logger.error(f"failed to {info} on attempt {attempt} with {error}. Cannot continue.",
+                         extra={'endpoint': endpoint})
+        else:
+            logger.warning(f"API to {info} failed attempt {attempt} of {self.max_attempts} with {error}. "
+                           f"Retrying in {delay:.1f} seconds", extra={'endpoint': endpoint})
+        return delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def time_left(self):
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - (time.monotonic() - self.started_at)
+
+    def next_delay(self, attempt, error):
+        # returns the seconds to wait before the next attempt, or None if the call should not be retried
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+        delay = self.delay(attempt)
+        # never come back sooner than XIQ asked for with Retry-After
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if delay > self.time_left():
+            logger.warning("retry deadline reached, no more retries will be made this run")
+            return None
+        with self.lock:
+            if self.retries_left <= 0:
+                logger.warning("retry budget used up, no more retries will be made this run")
+                return None
+            self.retries_left -= 1
+        return delay
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+import logging
+import os
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from app.logger import logger, log_context, set_run_id, configure_logging
+from app.xiq_api import XIQ, APICallFailedException
+from app.retry import RetryPolicy, CircuitBreaker
+from app.rate_limiter import RateLimiter
+from app.metrics import RunMetrics, stage, section
+from app.response_cache import ResponseCache
+import app.email_backends as email_backends
+from app.psk_store import CSVStore, SQLiteStore, PSKStoreError
+from app.psk_generator import PSKPolicy, PSKGenerator, PSKHistory, refill
+from app.mismatch_tracker import MismatchTracker, group_by_location
+from app.notifier import Notifier
+logger = logging.getLogger('PSK_Rotator.rotator')
+
+# the script folder - relative paths of files the script keeps for itself (token_cache) are in it, like the log
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# variables.yml settings used to build the XIQ client. The client is only rebuilt when one of them changes
+XIQ_SETTINGS = ('XIQ_token', 'XIQ_username', 'XIQ_password', 'token_cache', 'token_refresh_margin', 'XIQ_url', 'XIQ_pool_size', 'XIQ_connect_timeout', 'XIQ_read_timeout', 'page_size',
+                'page_workers', 'poll_interval', 'poll_max_interval', 'lro_timeout', 'retry_attempts',
+                'retry_base_delay', 'retry_max_delay', 'retry_budget', 'retry_deadline', 'breaker_threshold',
+                'breaker_reset_time', 'rate_limit', 'rate_burst', 'push_batch_size', 'push_workers',
+                'push_batch_retries', 'track_deployments', 'response_cache')
+
+
+class RotationAborted(Exception):
+    # the rotation could not continue. The support email has already been sent
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def load_config(path):
+    # raises FileNotFoundError or yaml.YAMLError
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+def write_run_report(yml_variables, metrics, default_dir):
+    # run report (json) and prometheus textfile collector file
+    if not yml_variables.get('run_report', True):
+        return
+    report_dir = yml_variables.get('report_dir') or default_dir
+    try:
+        metrics.write_json(os.path.join(report_dir, "PSK_rotator_report.json"))
+        metrics.write_prometheus(os.path.join(report_dir, "PSK_rotator.prom"))
+    except OSError as e:
+        logger.error(f"Failed to write run report to {report_dir} - {e}")
+
+# SSID Functions
+#################################################################################################
+def load_ssid_list(yml_variables):
+    # 'ssids' in variables.yml lists every SSID to rotate. Older variable files with a single
+    # SSID_ID/file_name are treated as a list with one SSID.
+    ssid_defaults = {
+        'file_name': yml_variables.get('file_name'),
+        'email_list': yml_variables.get('email_list', []),
+        'email_msg': yml_variables.get('email_msg', ''),
+        'email_sub': yml_variables.get('email_sub', ''),
+        'schedule': yml_variables.get('schedule'),
+    }
+    if 'ssids' in yml_variables:
+        return [{**ssid_defaults, **ssid} for ssid in yml_variables['ssids']]
+    return [{**ssid_defaults, 'SSID_ID': yml_variables['SSID_ID']}]
+
+def log_summary(results, config_status_msg):
+    lines = ["PSK rotation summary:"]
+    for result in results:
+        if result['psk_updated']:
+            lines.append(f"  SSID {result['SSID_ID']}: PSK changed")
+        else:
+            lines.append(f"  SSID {result['SSID_ID']}: FAILED - {result['error']}")
+    if config_status_msg:
+        lines.append(f"  Configuration push: {config_status_msg}")
+    summary = "\n".join(lines)
+    print(summary)
+    logger.info(summary)
+    return summary
+
+
+class Rotator:
+    # Runs PSK rotations. The XIQ client and email clients are kept between calls to rotate()
+    # so a long running process does not reconnect or re-authenticate for every run.
+    def __init__(self, yml_variables):
+        self.yml_variables = yml_variables
+        self.x = None
+        self.xiq_settings = None
+        self.email_clients = {}
+        self.notifier = None
+        self.psk_stores = {}
+        self.psk_generator = None
+        self.psk_history = None
+        self.metrics = None
+        # optional callback(ssid), called right before an SSID's PSK is changed in XIQ. It can raise
+        # RotationAborted to stop the change
+        self.before_psk_change = None
+        # optional callback(result), called as soon as an SSID's PSK was changed in XIQ
+        self.on_psk_changed = None
+
+    def update_config(self, yml_variables):
+        # use new variables for the next run. Email clients are rebuilt as their settings may have changed,
+        # the XIQ client only if its own settings changed
+        self.close_notifier()
+        self.yml_variables = yml_variables
+        self.close_psk_stores()
+
+    def close(self):
+        self.close_notifier()
+        if self.x is not None:
+            self.x.close()
+            self.x = None
+        self.close_psk_stores()
+
+    # PSK stores
+    #############################################################################################
+    def get_psk_store(self, ssid):
+        # psk_store: sqlite keeps every SSID in one database, otherwise each SSID uses its csv file
+        if self.yml_variables.get('psk_store', 'csv') == 'sqlite':
+            if 'sqlite' not in self.psk_stores:
+                self.psk_stores['sqlite'] = SQLiteStore(self.yml_variables['psk_db'])
+            store = self.psk_stores['sqlite']
+            # the first time an SSID is seen its csv file is imported
+            if not store.known(ssid['SSID_ID']) and ssid.get('file_name'):
+                if os.path.exists(ssid['file_name']):
+                    store.import_csv(ssid['SSID_ID'], ssid['file_name'])
+                elif not (self.yml_variables.get('psk_generator') or {}).get('enabled'):
+                    raise PSKStoreError(f"File {ssid['file_name']} does not exist and SSID {ssid['SSID_ID']} has no "
+                                        f"PSKs in {self.yml_variables['psk_db']}. Please check variables.yml")
+            return store
+        if ssid['file_name'] not in self.psk_stores:
+            self.psk_stores[ssid['file_name']] = CSVStore(ssid['file_name'])
+        return self.psk_stores[ssid['file_name']]
+
+    def close_psk_stores(self):
+        for store in self.psk_stores.values():
+            store.close()
+        self.psk_stores = {}
+        self.psk_generator = None
+        self.psk_history = None
+
+    def get_psk_history(self):
+        # hashed history of every generated or used PSK, None if no psk_history file is set or the
+        # generator (the only reader of the history) is disabled
+        if not (self.yml_variables.get('psk_generator') or {}).get('enabled'):
+            return None
+        if self.psk_history is None and self.yml_variables.get('psk_history'):
+            self.psk_history = PSKHistory(self.yml_variables['psk_history'],
+                                          capacity=self.yml_variables.get('psk_history_capacity', 1000000))
+        return self.psk_history
+
+    def refill_psks(self, store, ssid):
+        # generates new PSKs for the SSID when its pool runs low and psk_generator is enabled
+        settings = self.yml_variables.get('psk_generator') or {}
+        if not settings.get('enabled'):
+            return
+        if self.psk_generator is None:
+            self.psk_generator = PSKGenerator(PSKPolicy.from_variables(settings))
+        history = self.get_psk_history()
+        if history is None:
+            history = self.psk_history = PSKHistory(None)
+            logger.warning("psk_history is not set, generated PSKs are only checked against this run")
+        refill(store, ssid['SSID_ID'], self.psk_generator, history,
+               low_water=settings.get('low_water', 10), batch_size=settings.get('batch_size', 100))
+
+    # XIQ
+    #############################################################################################
+    def get_xiq(self):
+        yml_variables = self.yml_variables
+        settings = tuple(yml_variables.get(key) for key in XIQ_SETTINGS)
+        if self.x is not None and settings == self.xiq_settings:
+            self.x.retry_policy.start()
+            return self.x
+        self.close()
+        cache_settings = yml_variables.get('response_cache') or {}
+        response_cache = None
+        if cache_settings.get('enabled'):
+            response_cache = ResponseCache(ttls=cache_settings.get('ttls') or {"/devices": 5, "/locations/tree": 3600},
+                                           max_entries=cache_settings.get('max_entries', 256))
+        self.x = XIQ(user_name=yml_variables.get('XIQ_username'),
+                     password=yml_variables.get('XIQ_password'),
+                     token=yml_variables.get('XIQ_token'),
+                     token_cache=yml_variables.get('token_cache') and os.path.join(SCRIPT_DIR, yml_variables['token_cache']),
+                     token_refresh_margin=yml_variables.get('token_refresh_margin', 300),
+                     pool_size=yml_variables.get('XIQ_pool_size', 10),
+                     connect_timeout=yml_variables.get('XIQ_connect_timeout', 10),
+                     read_timeout=yml_variables.get('XIQ_read_timeout', 60),
+                     page_size=yml_variables.get('page_size', 100),
+                     page_workers=yml_variables.get('page_workers', 4),
+                     poll_interval=yml_variables.get('poll_interval', 2),
+                     poll_max_interval=yml_variables.get('poll_max_interval', 30),
+                     lro_timeout=yml_variables.get('lro_timeout', 600),
+                     retry_policy=RetryPolicy(max_attempts=yml_variables.get('retry_attempts', 5),
+                                              base_delay=yml_variables.get('retry_base_delay', 1),
+                                              max_delay=yml_variables.get('retry_max_delay', 30),
+                                              retry_budget=yml_variables.get('retry_budget', 50),
+                                              deadline=yml_variables.get('retry_deadline', 900),
+                                              breaker=CircuitBreaker(failure_threshold=yml_variables.get('breaker_threshold', 5),
+                                                                     reset_timeout=yml_variables.get('breaker_reset_time', 60))),
+                     rate_limiter=RateLimiter(max_rate=yml_variables.get('rate_limit', 10),
+                                              burst=yml_variables.get('rate_burst', 10)),
+                     base_url=yml_variables.get('XIQ_url', "https://api.extremecloudiq.com"),
+                     push_batch_size=yml_variables.get('push_batch_size', 500),
+                     push_workers=yml_variables.get('push_workers', 4),
+                     push_batch_retries=yml_variables.get('push_batch_retries', 1),
+                     response_cache=response_cache,
+                     track_deployments=yml_variables.get('track_deployments', False))
+        self.xiq_settings = settings
+        return self.x
+
+    def get_locations(self, x):
+        # 'locations' in variables.yml is a list of XIQ location ids, or 'discover' for every location of
+        # location_type in the location tree. Returns None when the whole tenant is scanned at once
+        locations = self.yml_variables.get('locations')
+        if not locations:
+            return None
+        if locations == 'discover':
+            return x.discover_locations(self.yml_variables.get('location_type', 'BUILDING'))
+        return list(locations)
+
+    # Email Functions
+    #############################################################################################
+    def send_email(self, isSuccess, msg, recipients, subject=None):
+        # queues the message for the notifier thread. subject lets a message use an SSID specific email_sub
+        logger.info(f"Script was successful: {isSuccess}")
+        self.get_notifier().submit(f"{msg}", recipients, subject)
+
+    def deliver_email(self, msg, recipients, subject=None):
+        # runs on the notifier thread, errors are raised so the notifier can try again
+        email_type = self.yml_variables['email_type']
+        try:
+            client = self.get_email_client(email_type)
+        except email_backends.UnknownEmailBackend as e:
+            print(f"email_type in variables.yml is incorrect - '{email_type}'. Message will only be logged.")
+            logger.info(f"email_type in variable.yml is incorrect - '{email_type}'. Email message: {msg}")
+            return
+        with section(self.metrics, "email_send"):
+            client.send_message(body=msg, recipients=recipients, subject=subject)
+
+    def get_notifier(self):
+        if self.notifier is None:
+            self.notifier = Notifier(self.deliver_email,
+                                     max_attempts=self.yml_variables.get('email_retry_attempts', 3),
+                                     base_delay=self.yml_variables.get('email_retry_delay', 2))
+        return self.notifier
+
+    def flush_emails(self):
+        # waits for queued emails, then closes the connections (SMTP) opened for this run. Clients without
+        # a connection (the Gmail API service) are kept for the next run
+        if self.notifier is not None:
+            self.notifier.flush()
+        for email_type, client in list(self.email_clients.items()):
+            if hasattr(client, 'close'):
+                client.close()
+                del self.email_clients[email_type]
+
+    def close_notifier(self):
+        self.flush_emails()
+        # the kept clients are rebuilt with the current settings next time
+        self.email_clients = {}
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+
+    def get_email_client(self, email_type):
+        # the backend module is only imported the first time its email_type is used
+        if email_type not in self.email_clients:
+            self.email_clients[email_type] = email_backends.new(email_type, self.yml_variables)
+        return self.email_clients[email_type]
+
+    def abort(self, msg):
+        # sends msg to the support email and stops the rotation
+        self.send_email(False, msg, self.yml_variables['support_email_list'])
+        self.flush_emails()
+        print("Script is exiting...")
+        raise RotationAborted(msg)
+
+    # Rotation
+    #############################################################################################
+    def rotate_ssid(self, x, ssid):
+        # changes the PSK of a single SSID. The PSK is only removed from the store once XIQ has
+        # accepted it. Returns a result dict used for the emails and the run summary
+        result = {'SSID_ID': ssid['SSID_ID'], 'ssid': ssid, 'psk_updated': False, 'new_psk': None, 'error': None}
+        try:
+            with stage(self.metrics, "psk_read"):
+                store = self.get_psk_store(ssid)
+                self.refill_psks(store, ssid)
+                reservation = store.reserve(ssid['SSID_ID'])
+        except (PSKStoreError, OSError, ValueError) as e:
+            result['error'] = str(e)
+            logger.error(result['error'])
+            return result
+        if reservation is None:
+            result['error'] = f"There are no PSKs left for SSID {ssid['SSID_ID']}"
+            logger.warning(result['error'])
+            return result
+
+        if self.before_psk_change is not None:
+            try:
+                self.before_psk_change(ssid)
+            except RotationAborted:
+                store.rollback(reservation)
+                raise
+        response = x.change_PSK(ssid['SSID_ID'],reservation.psk)
+        if response != "Success":
+            store.rollback(reservation)
+            result['error'] = "Script failed to change PSK. Please check logs"
+            return result
+        result['psk_updated'] = True
+        result['new_psk'] = reservation.psk
+        logger.info(f"Successfully updated psk for SSID {ssid['SSID_ID']} to {reservation.psk}")
+        # the PSK is added back to the end of the pool if reuse_psks is True
+        store.commit(reservation, reuse=self.yml_variables['reuse_psks'])
+        logger.info(f"Successfully updated PSK store for SSID {ssid['SSID_ID']}")
+        if self.on_psk_changed is not None:
+            self.on_psk_changed(result)
+        if self.get_psk_history() is not None:
+            self.psk_history.add([reservation.psk])
+        if self.yml_variables.get('email_before_push', True):
+            # users get the new PSK right away instead of after the config push
+            email_body = f"{ssid['email_msg']} {reservation.psk}\n\n"
+            if self.yml_variables['allow_config_push']:
+                email_body += "The configuration is being pushed to the access points now."
+            else:
+                email_body += 'Configuration pushing is disabled in script. New PSK will be used once configuration is pushed.'
+            self.send_email(True, email_body, ssid['email_list'], subject=ssid['email_sub'])
+        return result
+
+    def rotate(self, ssid_list=None, metrics=None):
+        # rotates the PSK of every SSID in ssid_list (default: all SSIDs in variables.yml) with one shared
+        # mismatch scan and config push. Returns the per SSID results, raises RotationAborted on failure
+        yml_variables = self.yml_variables
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        configure_logging(yml_variables.get('log_format', 'text'), yml_variables.get('log_level', 'INFO'))
+        # every log record of this run carries its run id, the same one as in the run report
+        set_run_id(self.metrics.run_id)
+        if not yml_variables.get('XIQ_token') and not yml_variables.get('XIQ_username'):
+            log_msg = ("No XIQ API token or XIQ username provided. Please generate a token and run the script again.")
+            print(log_msg)
+            # log message
+            logger.error(log_msg)
+            # send message to support email
+            log_msg += " Please check variables.yml"
+            self.abort(log_msg)
+        try:
+            x = self.get_xiq()
+        except APICallFailedException as e:
+            # send message to support email
+            self.abort(f"Script failed to log in to XIQ.\n - {str(e)}\nCheck logs for more details")
+        x.metrics = self.metrics
+        if ssid_list is None:
+            ssid_list = load_ssid_list(yml_variables)
+
+        try:
+            location_ids = self.get_locations(x)
+        except APICallFailedException as e:
+            # send message to support email
+            self.abort(f"Script failed to collect the XIQ locations.\n - {str(e)}\nCheck logs for more details")
+        if location_ids is not None and not location_ids:
+            self.abort(f"No XIQ locations of type {yml_variables.get('location_type', 'BUILDING')} were found. Please check variables.yml")
+        location_workers = yml_variables.get('location_workers', 4)
+        tracker = MismatchTracker(x, quiet_period=yml_variables.get('mismatch_quiet_period', 15),
+                                  timeout=yml_variables.get('mismatch_timeout', 60),
+                                  location_ids=location_ids, workers=location_workers)
+
+        # Check for any devices in mismatched state. One scan covers every SSID
+        try:
+            with stage(self.metrics, "mismatch_precheck"):
+                if location_ids:
+                    devices_by_location = x.scan_locations(location_ids, workers=location_workers, fields=["ID", "HOSTNAME"])
+                    mismatched_devices = [device for devices in devices_by_location.values() for device in devices]
+                    tracker.snapshot({device.id: location_id for location_id, devices in devices_by_location.items()
+                                      for device in devices})
+                else:
+                    mismatched_devices = x.collectMismatchDevices(views="BASIC", fields=["ID", "HOSTNAME"])
+                    tracker.snapshot(mismatched_devices)
+        except APICallFailedException as e:
+            # send message to support email
+            self.abort(f"Script failed to collect devices in mismatched state.\n - {str(e)}\nCheck logs for more details")
+        if len(mismatched_devices) > 0 and not yml_variables['allow_mismatched']:
+            #Do this is mismatched devices and allow_mismatched is set to False
+            log_msg = f"Mismatches devices were found in XIQ. Yaml settings are set to not allow mismatches. PSK will not be changed"
+            logger.warning(log_msg)
+            log_msg += f"\n\nThe following APs are in a mismatched state: \n{chr(10).join([str(d.hostname) for d in mismatched_devices])}"
+            # send message to support email
+            self.abort(log_msg)
+
+        # rotate every SSID concurrently, log records of each carry its SSID
+        def rotate_with_context(ssid):
+            with log_context(ssid=ssid['SSID_ID']):
+                return self.rotate_ssid(x, ssid)
+
+        with stage(self.metrics, "psk_change"), ThreadPoolExecutor(max_workers=max(1, min(yml_variables.get('ssid_workers', 8), len(ssid_list)))) as executor:
+            results = list(executor.map(rotate_with_context, ssid_list))
+        if self.psk_history is not None:
+            try:
+                self.psk_history.save()
+            except OSError as e:
+                # the PSKs are already changed in XIQ, the push and the emails still have to happen
+                log_msg = f"Failed to save the PSK history {self.psk_history.path} - {e}. Please check psk_history in variables.yml"
+                logger.error(log_msg)
+                self.send_email(False, log_msg, yml_variables['support_email_list'])
+        psk_updated = any(result['psk_updated'] for result in results)
+
+        # one config push covers every SSID that was changed
+        config_status_msg = ""
+        if yml_variables['allow_config_push'] and psk_updated:
+            push_preexisting = yml_variables.get('push_preexisting_mismatches', False)
+            try:
+                with stage(self.metrics, "mismatch_wait"):
+                    # only the devices the PSK change made mismatched are pushed, unless push_preexisting_mismatches
+                    devices = tracker.wait()
+                    preexisting = tracker.preexisting()
+                    if preexisting and push_preexisting:
+                        devices.update(preexisting)
+            except APICallFailedException as e:
+                # send message to support email
+                self.abort(f"PSK has been added by script but failed to collect devices for config push.\n - {str(e)}.\nCheck logs for more details")
+            device_ids = list(devices)
+            if location_ids:
+                devices_by_location = group_by_location(devices, location_ids)
+            if preexisting and not push_preexisting:
+                logger.warning(f"{len(preexisting)} devices were mismatched before the PSK change and are not pushed: "
+                               f"{', '.join(str(device_id) for device_id in preexisting)}")
+            if device_ids:
+                print(f"pushing configuration to {len(device_ids)} devices")
+                if location_ids:
+                    # staged rollout, site by site
+                    push_result = x.configPushBySite(devices_by_location,
+                                                     sites_in_flight=yml_variables.get('sites_in_flight', 1),
+                                                     stop_on_failure=yml_variables.get('rollout_stop_on_failure', True))
+                else:
+                    push_result = x.configPushInBatches(device_ids)
+                config_status = push_result['status']
+                if config_status == "FAILED" and all(batch['error'] for batch in push_result['batches']):
+                    # no batch could be deployed at all
+                    errors = "\n - ".join(sorted({batch['error'] for batch in push_result['batches']}))
+                    self.abort(f"PSK has been added by script but failed to push the configuration with errors.\n - {errors}.\nCheck logs for more details")
+                if config_status != "SUCCEEDED":
+                    if config_status[-2:] == 'ED' :
+                        config_status_msg = f"The configuration push {config_status}"
+                    else:
+                        config_status_msg = f"The configuration push is {config_status}"
+                    not_pushed = push_result['retry_devices']
+                    config_status_msg += f" ({len(not_pushed)} of {len(push_result['devices'])} devices not confirmed)"
+                    skipped_sites = [str(location_id) for location_id, status in push_result.get('sites', {}).items() if status == "SKIPPED"]
+                    if skipped_sites:
+                        config_status_msg += f"\nThe rollout was stopped, these locations were not pushed: {', '.join(skipped_sites)}"
+            else:
+                config_status_msg = f"There are currently no online devices"
+            if preexisting and not push_preexisting:
+                config_status_msg += ("\n" if config_status_msg else "") + \
+                    f"{len(preexisting)} devices were already mismatched before the PSK change and were not pushed"
+        elif not yml_variables['allow_config_push'] and psk_updated:
+            config_status_msg = 'Configuration pushing is disabled in script. New PSK will be used once configuration is pushed.'
+
+        summary = log_summary(results, config_status_msg)
+        with stage(self.metrics, "email"):
+            for result in results:
+                ssid = result['ssid']
+                if not result['psk_updated']:
+                    continue
+                if not yml_variables.get('email_before_push', True):
+                    email_body = f"{ssid['email_msg']} {result['new_psk']}\n\n"
+                    email_body += config_status_msg
+                    self.send_email(True, email_body, ssid['email_list'], subject=ssid['email_sub'])
+                elif yml_variables['allow_config_push'] and config_status_msg:
+                    # the PSK was already sent, follow up when the push did not fully succeed
+                    self.send_email(True, config_status_msg, ssid['email_list'], subject=ssid['email_sub'])
+            if not all(result['psk_updated'] for result in results):
+                # send message to support email
+                self.send_email(False, summary, yml_variables['support_email_list'])
+            self.flush_emails()
+        return results
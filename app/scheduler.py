@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+import yaml
+from app.logger import logger
+from app.metrics import RunMetrics
+from app.rotator import Rotator, RotationAborted, load_config, load_ssid_list, write_run_report
+logger = logging.getLogger('PSK_Rotator.scheduler')
+
+
+class CronSchedule:
+    # Standard 5 field cron expression: minute hour day-of-month month day-of-week.
+    # Each field accepts *, numbers, ranges (1-5), steps (*/15, 0-30/10) and lists (1,15).
+    # Day of week is 0-6 with 0 (or 7) as Sunday.
+    FIELDS = (("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"cron schedule '{expression}' must have 5 fields")
+        values = [self.__parse_field(part, low, high) for part, (name, low, high) in zip(parts, self.FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        self.weekdays = {day % 7 for day in weekdays}
+        # cron runs on a matching day of month OR day of week when both are restricted
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def __parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            step = None
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(value) for value in part.split("-"))
+            else:
+                # 5/20 is every 20 from 5 to the end of the range, like cron
+                start = int(part)
+                end = high if step is not None else start
+            step = step if step is not None else 1
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"cron field '{field}' is out of range {low}-{high}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def __day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.isoweekday() % 7) in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment):
+        # returns the first matching minute after moment
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months or not self.__day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+                continue
+            if moment.minute in self.minutes:
+                return moment
+            moment += timedelta(minutes=1)
+        raise ValueError(f"cron schedule '{self.expression}' never runs")
+
+
+class Daemon:
+    # Runs rotations on the cron 'schedule' of each SSID (or the top level 'schedule') until stopped.
+    # The Rotator, and with it the XIQ session and email clients, is kept between runs. variables.yml
+    # is only read again when the file changes.
+    def __init__(self, config_path, report_dir, check_interval=30):
+        self.config_path = config_path
+        self.report_dir = report_dir
+        self.check_interval = check_interval
+        self.config_mtime = None
+        self.rotator = None
+        self.schedules = []
+
+    def reload_config(self):
+        # returns True if variables.yml was (re)loaded
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError as e:
+            logger.error(f"Unable to read {self.config_path} - {e}")
+            return False
+        if mtime == self.config_mtime:
+            return False
+        try:
+            yml_variables = load_config(self.config_path)
+            schedules = []
+            for ssid in load_ssid_list(yml_variables):
+                if not ssid.get('schedule'):
+                    logger.warning(f"SSID {ssid['SSID_ID']} has no schedule and will not be rotated by the daemon")
+                    continue
+                schedules.append((CronSchedule(ssid['schedule']), ssid))
+        except (OSError, yaml.YAMLError, ValueError, KeyError) as e:
+            # keep running with the last good config
+            logger.error(f"variables.yml could not be loaded, keeping the previous settings - {e}")
+            self.config_mtime = mtime
+            return False
+        self.config_mtime = mtime
+        if self.rotator is None:
+            self.rotator = Rotator(yml_variables)
+        else:
+            self.rotator.update_config(yml_variables)
+        now = datetime.now()
+        self.schedules = [[schedule, schedule.next_after(now), ssid] for schedule, ssid in schedules]
+        logger.info(f"loaded {self.config_path} with {len(self.schedules)} scheduled SSIDs")
+        return True
+
+    def run_due(self, now):
+        # runs one rotation for every SSID that is due, sharing the mismatch scan and push between them
+        due = [entry for entry in self.schedules if entry[1] <= now]
+        if not due:
+            return
+        for entry in due:
+            entry[1] = entry[0].next_after(now)
+        ssid_list = [entry[2] for entry in due]
+        print(f"{now:%Y-%m-%d %H:%M} rotating SSIDs {', '.join(str(ssid['SSID_ID']) for ssid in ssid_list)}")
+        metrics = RunMetrics()
+        try:
+            self.rotator.rotate(ssid_list=ssid_list, metrics=metrics)
+        except RotationAborted as e:
+            logger.error(f"rotation stopped - {e}")
+        except Exception as e:
+            logger.exception(f"rotation failed with unexpected error - {e}")
+        finally:
+            write_run_report(self.rotator.yml_variables, metrics, self.report_dir)
+
+    def run_forever(self):
+        self.reload_config()
+        if self.rotator is None:
+            raise SystemExit(f"Unable to start daemon, {self.config_path} could not be loaded")
+        print(f"PSK rotator daemon started with {len(self.schedules)} scheduled SSIDs")
+        try:
+            while True:
+                self.run_due(datetime.now())
+                next_run = min((entry[1] for entry in self.schedules), default=None)
+                sleep_time = self.check_interval
+                if next_run is not None:
+                    sleep_time = max(0, min(sleep_time, (next_run - datetime.now()).total_seconds()))
+                time.sleep(sleep_time)
+                self.reload_config()
+        except KeyboardInterrupt:
+            print("PSK rotator daemon stopped")
+        finally:
+            self.rotator.close()
@@ -18,23 +18,43 @@ class new():
  #################################################################################################
     def __init__(self, yml_variables):
         self.yml_variables = yml_variables
+        # one logged in session is used for every message until close()
+        self.server = None
 
+    def __connect(self):
+        server = smtplib.SMTP(self.yml_variables['smtp_server'], self.yml_variables['smtp_port'], timeout=30)
+        server.starttls()
+        server.login(self.yml_variables['smtp_username'],self.yml_variables['smtp_password'])
+        return server
 
-    def send_message(self, body, recipients):
+    def send_message(self, body, recipients, subject=None):
             # Build the email
             toHeader = ", ".join(recipients)
             msg = MIMEMultipart()
-            msg['Subject'] = self.yml_variables['email_sub']
+            msg['Subject'] = subject or self.yml_variables['email_sub']
             msg['From'] = self.yml_variables['smtp_sender_email']
             msg['To'] = toHeader
             msg.attach(MIMEText(body))
             try:
-                server = smtplib.SMTP(self.yml_variables['smtp_server'], self.yml_variables['smtp_port'])
-                server.starttls()
-                server.login(self.yml_variables['smtp_username'],self.yml_variables['smtp_password'])
-                server.send_message(msg)
-                server.quit()
+                if self.server is None:
+                    self.server = self.__connect()
+                try:
+                    self.server.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # the server closed the idle session, log in again
+                    self.server = self.__connect()
+                    self.server.send_message(msg)
                 #debug_print "email sent: %s" % fromaddr
             except Exception as e:
-                    logmsg = "Something went wrong when sending the email to {}".format(self.yml_variables['smtp_sender_email'])
-                    logger.error(logmsg)
\ No newline at end of file
+                    logmsg = "Something went wrong when sending the email to {} - {}".format(', '.join(recipients), e)
+                    logger.error(logmsg)
+                    self.close()
+                    raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
\ No newline at end of file
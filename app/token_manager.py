@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from app.logger import logger
+from app.atomic_file import atomic_write
+try:
+    import fcntl
+except ImportError:
+    # windows - the cache is still used but not locked between processes
+    fcntl = None
+logger = logging.getLogger('PSK_Rotator.token_manager')
+
+
+class TokenManager:
+    # Hands out an XIQ access token obtained with login(), which returns (token, expires_in seconds).
+    # The token and its expiry are kept in memory and, with cache_path, in a 0600 json file so the
+    # next run and other XIQ instances (threads or processes) reuse it instead of logging in again.
+    # A token is replaced refresh_margin seconds before it expires. The file is locked while a login
+    # is in progress so only one instance logs in.
+    def __init__(self, login, cache_path=None, key="default", refresh_margin=300, default_lifetime=3600):
+        self.login = login
+        self.cache_path = cache_path
+        self.key = key
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+
+    def __valid(self, expires_at):
+        return time.time() < expires_at - self.refresh_margin
+
+    def get_token(self):
+        with self.lock:
+            if self.token and self.__valid(self.expires_at):
+                return self.token
+            with self.__file_lock():
+                entry = self.__read_cache().get(self.key)
+                if entry and entry['token'] != self.token and self.__valid(entry['expires_at']):
+                    # another run or instance already logged in
+                    logger.info("using the cached XIQ token")
+                else:
+                    token, expires_in = self.login()
+                    entry = {'token': token, 'expires_at': time.time() + (expires_in or self.default_lifetime)}
+                    self.__write_cache(entry)
+                    logger.info(f"logged in to XIQ, the token expires in {int(entry['expires_at'] - time.time())} seconds")
+            self.token = entry['token']
+            self.expires_at = entry['expires_at']
+            return self.token
+
+    def invalidate(self, token):
+        # XIQ rejected token (401). The next get_token() logs in again, unless the token was already replaced
+        with self.lock:
+            if token == self.token:
+                logger.warning("XIQ rejected the access token, logging in again")
+                self.expires_at = 0
+
+    @contextmanager
+    def __file_lock(self):
+        if not self.cache_path or fcntl is None:
+            yield
+            return
+        with open(self.cache_path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __read_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"ignoring unreadable token cache {self.cache_path} - {e}")
+            return {}
+
+    def __write_cache(self, entry):
+        if not self.cache_path:
+            return
+        cache = self.__read_cache()
+        cache[self.key] = entry
+        try:
+            atomic_write(self.cache_path, json.dumps(cache), file_mode=0o600)
+        except OSError as e:
+            logger.warning(f"Unable to write token cache {self.cache_path} - {e}")
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+import yaml
+from app.logger import logger
+from app.metrics import RunMetrics
+from app.rotator import Rotator, RotationAborted, load_config, load_ssid_list, write_run_report
+from app.scheduler import CronSchedule
+logger = logging.getLogger('PSK_Rotator.worker')
+
+
+class JobTable:
+    # Rotation jobs shared by every worker, one row per tenant, SSID and schedule time. The unique key
+    # means a scheduled rotation can only be added once however many workers add it.
+    #   pending -> running (claimed with a lease) -> done or failed
+    # A running job whose lease ran out (the worker stopped sending heartbeats) can be claimed again.
+    # The database can be on shared storage. It uses a rollback journal instead of WAL, which needs
+    # shared memory between the processes.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tenant TEXT NOT NULL,
+                ssid_id TEXT NOT NULL,
+                scheduled_for REAL NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                not_before REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                psk_changed INTEGER NOT NULL DEFAULT 0,
+                finished_at REAL,
+                error TEXT,
+                UNIQUE (tenant, ssid_id, scheduled_for)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, scheduled_for);
+        """)
+
+    def __transaction(self, statements):
+        # runs statements(connection) in one write transaction and returns its result
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.connection)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return result
+
+    def add(self, tenant, ssid_id, scheduled_for):
+        # returns True if the job was new
+        return self.__transaction(lambda connection: connection.execute(
+            "INSERT OR IGNORE INTO jobs (tenant, ssid_id, scheduled_for) VALUES (?, ?, ?)",
+            (tenant, str(ssid_id), scheduled_for)).rowcount == 1)
+
+    def claim(self, worker, tenants, lease_time, max_attempts):
+        # takes the oldest due job of one of tenants. Returns the job row as a dict or None
+        now = time.time()
+        placeholders = ",".join("?" * len(tenants))
+
+        def claim_next(connection):
+            row = connection.execute(
+                f"SELECT id FROM jobs WHERE tenant IN ({placeholders}) AND scheduled_for <= ? AND attempts < ? "
+                f"AND (state = 'pending' AND (not_before IS NULL OR not_before <= ?) "
+                f"OR state = 'running' AND lease_until < ?) ORDER BY scheduled_for LIMIT 1",
+                (*tenants, now, max_attempts, now, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                               "WHERE id = ?", (worker, now + lease_time, row[0]))
+            return self.__get(connection, row[0])
+
+        return self.__transaction(claim_next)
+
+    def __get(self, connection, job_id):
+        cursor = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        columns = [column[0] for column in cursor.description]
+        return dict(zip(columns, cursor.fetchone()))
+
+    def heartbeat(self, job_id, worker, lease_time):
+        # extends the lease. Returns False if the job was taken over by another worker
+        return self.__transaction(lambda connection: connection.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time() + lease_time, job_id, worker)).rowcount == 1)
+
+    def mark_psk_changed(self, job_id, worker):
+        # recorded even if another worker has taken the job over since, so it does not change the PSK again.
+        # Returns False if the job is no longer held by worker
+        return self.__transaction(lambda connection: connection.execute(
+            "UPDATE jobs SET psk_changed = 1 WHERE id = ?", (job_id,)).rowcount == 1 and
+            connection.execute("SELECT worker FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] == worker)
+
+    def finish(self, job_id, worker, state, error=None, retry_delay=0):
+        # state is 'done', 'failed' or 'pending' (tried again after retry_delay seconds)
+        now = time.time()
+        self.__transaction(lambda connection: connection.execute(
+            "UPDATE jobs SET state = ?, error = ?, finished_at = ?, not_before = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ?",
+            (state, error, now if state != 'pending' else None, now + retry_delay, job_id, worker)))
+
+    def expire(self, max_attempts):
+        # running jobs that ran out of attempts are failed so they stop being claimed
+        self.__transaction(lambda connection: connection.execute(
+            "UPDATE jobs SET state = 'failed', error = 'gave up after ' || attempts || ' attempts' "
+            "WHERE attempts >= ? AND (state = 'pending' OR (state = 'running' AND lease_until < ?))",
+            (max_attempts, time.time())))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class Worker:
+    # Worker mode: every worker adds the next scheduled rotation of each SSID in its tenants' variables
+    # files to the shared job table, then claims and runs due jobs one at a time. A claimed job is
+    # leased for lease_time seconds and the lease is renewed every heartbeat_interval seconds while the
+    # rotation runs, so a crashed worker's job is taken over once its lease ends. Tenants are named by
+    # 'tenant' in their variables file (default the file name) and every worker sharing them must use
+    # the same time zone.
+    def __init__(self, tenant_configs, db_path, report_dir, worker_id=None, lease_time=300, heartbeat_interval=60,
+                 poll_interval=15, max_attempts=3, retry_delay=300):
+        self.tenant_configs = tenant_configs
+        self.jobs = JobTable(db_path)
+        self.report_dir = report_dir
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_time = lease_time
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # tenant name -> {'path', 'mtime', 'yml_variables', 'ssids', 'rotator'}
+        self.tenants = {}
+
+    def load_tenants(self):
+        for path in self.tenant_configs:
+            try:
+                mtime = os.path.getmtime(path)
+                known_name = next((name for name, tenant in self.tenants.items() if tenant['path'] == path), None)
+                known = self.tenants.get(known_name)
+                if known is not None and known['mtime'] == mtime:
+                    continue
+                yml_variables = load_config(path)
+                name = str(yml_variables.get('tenant') or os.path.splitext(os.path.basename(path))[0])
+                ssids = {str(ssid['SSID_ID']): (CronSchedule(ssid['schedule']), ssid)
+                         for ssid in load_ssid_list(yml_variables) if ssid.get('schedule')}
+            except (OSError, yaml.YAMLError, ValueError, KeyError) as e:
+                logger.error(f"{path} could not be loaded, keeping the previous settings - {e}")
+                continue
+            rotator = None
+            if known is not None:
+                del self.tenants[known_name]
+                rotator = known['rotator']
+                if rotator is not None:
+                    rotator.update_config(yml_variables)
+            self.tenants[name] = {'path': path, 'mtime': mtime, 'yml_variables': yml_variables, 'ssids': ssids,
+                                  'rotator': rotator}
+            logger.info(f"loaded tenant {name} from {path} with {len(ssids)} scheduled SSIDs")
+
+    def schedule_jobs(self, now):
+        # the next run of every SSID. Workers that add the same run at the same time end up with one job
+        for name, tenant in self.tenants.items():
+            for ssid_id, (schedule, ssid) in tenant['ssids'].items():
+                scheduled_for = schedule.next_after(now).timestamp()
+                if self.jobs.add(name, ssid_id, scheduled_for):
+                    logger.info(f"scheduled tenant {name} SSID {ssid_id} for {datetime.fromtimestamp(scheduled_for)}")
+
+    def run_job(self, job):
+        tenant = self.tenants[job['tenant']]
+        schedule, ssid = tenant['ssids'].get(job['ssid_id'], (None, None))
+        if ssid is None:
+            self.jobs.finish(job['id'], self.worker_id, 'failed', "SSID is no longer in the tenant's variables file")
+            return
+        if tenant['rotator'] is None:
+            tenant['rotator'] = Rotator(tenant['yml_variables'])
+        rotator = tenant['rotator']
+        if job['psk_changed']:
+            # the worker that had the job stopped after changing the PSK - it is not changed a second time,
+            # but the push and the user email may not have happened
+            log_msg = (f"Tenant {job['tenant']} SSID {job['ssid_id']}: the PSK was changed by worker {job['worker']}, "
+                       f"which stopped before finishing the rotation. The configuration push and the email with the "
+                       f"new PSK may not have been done. Please check XIQ and the PSK file.")
+            logger.error(log_msg)
+            rotator.send_email(False, log_msg, tenant['yml_variables']['support_email_list'])
+            rotator.flush_emails()
+            self.jobs.finish(job['id'], self.worker_id, 'done', "PSK changed by a worker that stopped before finishing")
+            return
+        print(f"{self.worker_id} rotating tenant {job['tenant']} SSID {job['ssid_id']} (attempt {job['attempts']})")
+        stop = threading.Event()
+        lease_lost = threading.Event()
+
+        def check_lease(ssid):
+            # renews the lease before the PSK is changed, so a job taken over by another worker is not changed twice
+            try:
+                held = not lease_lost.is_set() and self.jobs.heartbeat(job['id'], self.worker_id, self.lease_time)
+            except sqlite3.Error as e:
+                logger.error(f"unable to renew the lease on job {job['id']} - {e}")
+                held = False
+            if not held:
+                lease_lost.set()
+                raise RotationAborted(f"lost the lease on job {job['id']}, the PSK of SSID {ssid['SSID_ID']} was not changed")
+
+        def psk_changed(result):
+            if not self.jobs.mark_psk_changed(job['id'], self.worker_id):
+                logger.error(f"job {job['id']} was taken over by another worker after the PSK of SSID "
+                             f"{job['ssid_id']} was changed")
+
+        rotator.before_psk_change = check_lease
+        rotator.on_psk_changed = psk_changed
+        heartbeat = threading.Thread(target=self.__heartbeat, args=(job['id'], stop, lease_lost), daemon=True)
+        heartbeat.start()
+        metrics = RunMetrics()
+        error = None
+        try:
+            results = rotator.rotate(ssid_list=[ssid], metrics=metrics)
+            if not results[0]['psk_updated']:
+                error = results[0]['error']
+        except RotationAborted as e:
+            error = str(e)
+        except Exception as e:
+            logger.exception(f"rotation failed with unexpected error - {e}")
+            error = str(e)
+        finally:
+            stop.set()
+            heartbeat.join()
+            rotator.before_psk_change = None
+            rotator.on_psk_changed = None
+            write_run_report(tenant['yml_variables'], metrics, self.report_dir)
+        if lease_lost.is_set():
+            # the job belongs to the worker that took it over
+            logger.warning(f"tenant {job['tenant']} SSID {job['ssid_id']} was stopped, another worker has the job - {error}")
+        elif error is None:
+            self.jobs.finish(job['id'], self.worker_id, 'done')
+        elif job['attempts'] < self.max_attempts:
+            logger.warning(f"tenant {job['tenant']} SSID {job['ssid_id']} failed, it will be tried again - {error}")
+            self.jobs.finish(job['id'], self.worker_id, 'pending', error, retry_delay=self.retry_delay)
+        else:
+            logger.error(f"tenant {job['tenant']} SSID {job['ssid_id']} failed after {job['attempts']} attempts - {error}")
+            self.jobs.finish(job['id'], self.worker_id, 'failed', error)
+
+    def __heartbeat(self, job_id, stop, lease_lost):
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                if not self.jobs.heartbeat(job_id, self.worker_id, self.lease_time):
+                    logger.error(f"lost the lease on job {job_id}, another worker has taken it over")
+                    lease_lost.set()
+                    return
+            except sqlite3.Error as e:
+                logger.error(f"heartbeat for job {job_id} failed - {e}")
+
+    def run_once(self, now=None):
+        # schedules and runs every job that is due. Returns the number of jobs run
+        self.load_tenants()
+        if not self.tenants:
+            return 0
+        self.schedule_jobs(now or datetime.now())
+        self.jobs.expire(self.max_attempts)
+        count = 0
+        while True:
+            job = self.jobs.claim(self.worker_id, list(self.tenants), self.lease_time, self.max_attempts)
+            if job is None:
+                return count
+            self.run_job(job)
+            count += 1
+            # a job finishing may make the next run of its SSID due to be scheduled
+            self.schedule_jobs(datetime.now())
+
+    def run_forever(self):
+        print(f"PSK rotator worker {self.worker_id} started for {len(self.tenant_configs)} tenants")
+        try:
+            while True:
+                try:
+                    self.run_once()
+                except sqlite3.Error as e:
+                    logger.error(f"job table {self.jobs.db_path} error - {e}")
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print(f"PSK rotator worker {self.worker_id} stopped")
+        finally:
+            for tenant in self.tenants.values():
+                if tenant['rotator'] is not None:
+                    tenant['rotator'].close()
+            self.jobs.close()
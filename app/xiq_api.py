@@ -5,137 +5,179 @@ import inspect
 import sys
 import json
 import time
+import threading
+import asyncio
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from pprint import pprint as pp
 current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir) 
-from requests.exceptions import HTTPError, ReadTimeout
+from requests.exceptions import HTTPError, ReadTimeout, Timeout, ConnectionError as RequestsConnectionError, RequestException
 from app.logger import logger
+from app.poller import Poller
+from app.retry import RetryPolicy
+from app.rate_limiter import RateLimiter, parse_retry_after
+from app.metrics import stage, section, endpoint_name
+from app.devices import parse_devices
+from app.token_manager import TokenManager
+from app.deployment_tracker import DeploymentTracker, FAILED, SUCCEEDED
+# aiohttp is only needed by AsyncXIQ and is imported the first time one is created
+aiohttp = None
 
 logger = logging.getLogger('PSK_Rotator.xiq_api')
 
 PATH = current_dir
 
+# LRO statuses that mean the operation has not finished yet
+LRO_ACTIVE_STATUSES = ("PENDING", "RUNNING")
+# an accepted deployment whose LRO status could not be read. It may still be running, so it is not pushed again
+LRO_UNKNOWN = "UNKNOWN"
+
 class APICallFailedException(Exception):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
 
+class APIHTTPError(ValueError):
+    # XIQ answered with an unexpected HTTP status code. retry_after is the Retry-After header in seconds
+    def __init__(self, message, status_code, retry_after=None):
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+def build_mismatch_devices_url(base_url, page, pageSize, views="BASIC", fields=None, location_id=None):
+    url = base_url + "/devices?views=" + views + "&page=" + str(page) + "&limit=" + str(pageSize) + "&connected=true&configMismatch=true"
+    if fields:
+        url = url + "".join("&fields=" + field for field in fields)
+    if location_id:
+        url = url  + "&locationId=" +str(location_id)
+    return url
+
+def combine_push_statuses(statuses):
+    # overall status of a batched config push from the final LRO status of each batch
+    if all(status == "SUCCEEDED" for status in statuses):
+        return "SUCCEEDED"
+    if any(status in LRO_ACTIVE_STATUSES or status == LRO_UNKNOWN for status in statuses):
+        return "RUNNING"
+    if any(status.endswith("SUCCEEDED") for status in statuses):
+        return "PARTIAL_SUCCEEDED"
+    return "FAILED"
+
+def build_deployment_payload(device_id_list):
+    return json.dumps({
+    "devices": {
+        "ids": 
+        device_id_list
+    },
+    "policy": {
+        "enable_complete_configuration_update": False,
+        "firmware_upgrade_policy": {
+        "enable_enforce_upgrade": False,
+        "enable_distributed_upgrade": False
+        },
+        "firmware_activate_option": {
+        "enable_activate_at_next_reboot": False,
+        "activation_delay_seconds": 0,
+        "activation_time": 0
+        }
+    }
+    })
+
 class XIQ:
-    def __init__(self, user_name=None, password=None, token=None):
-        self.URL = "https://api.extremecloudiq.com"
+    def __init__(self, user_name=None, password=None, token=None, pool_size=10, connect_timeout=10, read_timeout=60,
+                 page_size=100, page_workers=4, poll_interval=2, poll_max_interval=30, lro_timeout=600,
+                 retry_policy=None, rate_limiter=None, base_url="https://api.extremecloudiq.com", metrics=None,
+                 push_batch_size=500, push_workers=4, push_batch_retries=1, token_cache=None, token_refresh_margin=300,
+                 response_cache=None, track_deployments=False):
+        self.URL = base_url.rstrip('/')
+        # optional app.metrics.RunMetrics - records every HTTP call and the push/LRO stages
+        self.metrics = metrics
         self.headers = {"Accept": "application/json", "Content-Type": "application/json"}
-        self.totalretries = 5
+        # retry_policy decides which failed calls are retried and how long to wait between attempts
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # every call waits for the rate limiter so concurrent calls stay under the XIQ API quota
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        # device pages are requested with this limit, and up to page_workers pages are fetched at once
+        self.page_size = page_size
+        self.page_workers = page_workers
+        # LRO and mismatch checks start polling every poll_interval seconds and back off to poll_max_interval
+        self.poller = Poller(initial_interval=poll_interval, max_interval=poll_max_interval)
+        self.lro_timeout = lro_timeout
+        # config pushes are split into deployments of push_batch_size devices, up to push_workers run at once
+        # and a failed batch is pushed again up to push_batch_retries times
+        self.push_batch_size = push_batch_size
+        self.push_workers = push_workers
+        self.push_batch_retries = push_batch_retries
+        # follow every device of a push through /deployments/status, retries then only push the devices that failed
+        self.track_deployments = track_deployments
+        # (connect, read) timeout used on every call so a stalled socket can not hang the script
+        self.timeout = (connect_timeout, read_timeout)
+        # optional app.response_cache.ResponseCache for GET calls. It is invalidated after every change
+        self.response_cache = response_cache
+        # shared keep-alive session - connections to XIQ are pooled and reused across calls
+        self.session = requests.Session()
+        self.session.headers.update({"Connection": "keep-alive"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # with user_name/password the token comes from a TokenManager, which caches it in token_cache,
+        # renews it before it expires and after a 401
+        self.token_manager = None
         if token:
             self.headers["Authorization"] = "Bearer " + token
         else:
+            self.token_manager = TokenManager(lambda: self.__getAccessToken(user_name, password),
+                                              cache_path=token_cache, key=f"{self.URL}|{user_name}",
+                                              refresh_margin=token_refresh_margin)
+            # a failed login is raised as APICallFailedException so a long running daemon or worker
+            # can report it and try again on its next run
             try:
-                self.__getAccessToken(user_name, password)
-            except ValueError as e:
-                print(e)
-                raise SystemExit
-            except HTTPError as e:
-               print(e)
-               raise SystemExit
-            except:
-                log_msg = "Unknown Error: Failed to generate token for XIQ"
-                logger.error(log_msg)
-                print(log_msg)
-                raise SystemExit 
-    #API CALLS
-    def __setup_get_api_call(self, info, url):
-        success = 0
-        for count in range(1, self.totalretries):
-            try:
-                response = self.__get_api_call(url=url)
-            except ValueError as e:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with {e}")
-                print(log_msg)
-                logger.warning(log_msg)
+                self.token_manager.get_token()
+            except APICallFailedException as e:
+                self.session.close()
+                print("failed to get XIQ token. Cannot continue")
+                raise
             except Exception as e:
-                log_msg = (f"API to {info} failed with {e}")
+                self.session.close()
+                log_msg = f"Failed to generate token for XIQ - {e}"
                 logger.error(log_msg)
-                raise ValueError(log_msg)
-            except:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with unknown API error")
                 print(log_msg)
-                logger.warning(log_msg)
-            else:
-                success = 1
-                break
-        if success != 1:
-            log_msg = (f"failed to {info}. Cannot continue.")
-            log_msg += (" Check log file for details")
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if 'error' in response:
-            if response['error']['error_message']:
-                log_msg = (f"Error Code {response['error']['error_id']}: {response['error']['error_message']}")
-                logger.error(log_msg)
-                log_msg = (f"API Failed {info} with reason: {log_msg}")
                 raise APICallFailedException(log_msg)
-        return response
-    
-    def __setup_put_api_call(self, info, url, payload):
-        success = 0
-        for count in range(1, self.totalretries):
-            try:
-                response = self.__put_api_call(url=url, payload=payload)
-            except ValueError as e:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with {e}")
-                print(log_msg)
-                logger.warning(log_msg)
-            except Exception as e:
-                log_msg = (f"API to {info} failed with {e}")
-                logger.error(log_msg)
-                raise ValueError(log_msg)
-            except:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with unknown API error")
-                print(log_msg)
-                logger.warning(log_msg)
-            else:
-                success = 1
-                break
-        if success != 1:
-            log_msg = (f"failed to {info}. Cannot continue.")
-            log_msg += (" Check log file for details")
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if 'error' in response:
-            if response['error']['error_message']:
-                log_msg = (f"Error Code {response['error']['error_id']}: {response['error']['error_message']}")
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #API CALLS
+    def __setup_api_call(self, info, method, url, payload=None):
+        count = 1
+        while True:
+            if not self.retry_policy.allow():
+                log_msg = (f"failed to {info}. XIQ is not responding, calls are paused by the circuit breaker.")
                 logger.error(log_msg)
-                log_msg = (f"API Failed {info} with reason: {log_msg}")
                 raise APICallFailedException(log_msg)
-        return response
-    
-    def __setup_post_api_call(self, info, url, payload):
-        success = 0
-        for count in range(1, self.totalretries):
             try:
-                response = self.__post_api_call(url=url, payload=payload)
+                response = self.__api_call(method, url, payload, count)
             except ValueError as e:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with {e}")
-                print(log_msg)
-                logger.warning(log_msg)
-            except Exception as e:
-                log_msg = (f"API to {info} failed with {e}")
-                logger.error(log_msg)
-                raise ValueError(log_msg)
-            except:
-                log_msg = (f"API to {info} failed attempt {count} of {self.totalretries} with unknown API error")
-                print(log_msg)
-                logger.warning(log_msg)
+                delay = self.retry_policy.on_error(count, e, info, endpoint_name(url))
+                if delay is None:
+                    raise APICallFailedException(f"failed to {info} on attempt {count} with {e}. Cannot continue. "
+                                                 f"Check log file for details")
+                time.sleep(delay)
+                count += 1
             else:
-                success = 1
+                self.retry_policy.on_success()
                 break
-        if success != 1:
-            log_msg = (f"failed to {info}. Cannot continue.")
-            log_msg += (" Check log file for details")
-            logger.error(log_msg)
-            raise APICallFailedException(log_msg)
-        if 'error' in response:
+        if isinstance(response, dict) and 'error' in response:
             if response['error']['error_message']:
                 log_msg = (f"Error Code {response['error']['error_id']}: {response['error']['error_message']}")
                 logger.error(log_msg)
@@ -143,46 +185,74 @@ class XIQ:
                 raise APICallFailedException(log_msg)
         return response
 
-    def __get_api_call(self, url):
-        try:
-            response = requests.get(url, headers= self.headers)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise ValueError(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise ValueError(log_msg)
-        if response.status_code != 200:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            logger.error(f"{log_msg}")
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.warning(f"\t\t{response.text}")
-            else:
-                if 'error_message' in data:
-                    logger.warning(f"\t\t{data['error_message']}")
-                else:
-                    logger.warning(f"\n\n{data}")
-            raise ValueError(log_msg) 
-        try:
-            data = response.json()
-        except json.JSONDecodeError:
-            logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
-            raise ValueError("Unable to parse the data from json, script cannot proceed")
-        return data
-    
-    def __put_api_call(self, url, payload):
+    def __setup_get_api_call(self, info, url):
+        if self.response_cache is not None and self.response_cache.cacheable(url):
+            data = self.response_cache.get(url)
+            if data is not None:
+                return data
+        return self.__setup_api_call(info, "GET", url)
+
+    def __setup_put_api_call(self, info, url, payload):
+        return self.__setup_api_call(info, "PUT", url, payload)
+
+    def __setup_post_api_call(self, info, url, payload):
+        return self.__setup_api_call(info, "POST", url, payload)
+
+    def __api_call(self, method, url, payload=None, attempt=1, replayed=False):
+        # GET returns the json data, PUT returns "Success", POST returns the json data or the
+        # response itself when XIQ accepts an async request (202)
+        headers = self.headers
+        # the managed token sent with this call, None with a static XIQ_token
+        token = None
+        if self.token_manager is not None and url != self.URL + "/login":
+            token = self.token_manager.get_token()
+            headers = {**self.headers, "Authorization": "Bearer " + token}
+        cached = method == "GET" and self.response_cache is not None and self.response_cache.cacheable(url)
+        if cached:
+            headers = {**headers, **self.response_cache.validators(url)}
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        status, response_bytes = "error", 0
         try:
-            response = requests.put(url, headers= self.headers, data=payload)
+            with section(self.metrics, f"api {method} {endpoint_name(url)}"):
+                response = self.session.request(method, url, headers=headers, data=payload, timeout=self.timeout)
+            status, response_bytes = response.status_code, len(response.content)
         except HTTPError as http_err:
             logger.error(f'HTTP error occurred: {http_err} - on API {url}')
             raise ValueError(f'HTTP error occurred: {http_err}') 
+        except Timeout as timeout_err:
+            logger.error(f'Timeout occurred: {timeout_err} - on API {url}')
+            raise ValueError(f'Timeout occurred: {timeout_err}')
+        except RequestsConnectionError as conn_err:
+            logger.error(f'Connection error occurred: {conn_err} - on API {url}')
+            raise ValueError(f'Connection error occurred: {conn_err}')
+        except RequestException as request_err:
+            # e.g. ChunkedEncodingError when a kept-alive connection drops in the middle of a response
+            logger.error(f'Request error occurred: {request_err} - on API {url}')
+            raise ValueError(f'Request error occurred: {request_err}')
+        finally:
+            latency = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.record_call(method, url, status, latency, response_bytes, attempt - 1)
+            logger.debug(f"{method} {url} - {status} in {latency:.3f} seconds",
+                         extra={'endpoint': endpoint_name(url), 'latency': round(latency, 6)})
         if response is None:
             log_msg = "ERROR: No response received from XIQ!"
             logger.error(log_msg)
             raise ValueError(log_msg)
+        self.rate_limiter.update(response.status_code, response.headers)
+        if response.status_code == 401 and token is not None and not replayed:
+            # the token expired or was revoked - log in once and replay the request
+            self.token_manager.invalidate(token)
+            return self.__api_call(method, url, payload, attempt, replayed=True)
+        if cached and response.status_code == 304:
+            data = self.response_cache.not_modified(url)
+            if data is not None:
+                return data
+            # the entry was evicted while the request was made - ask again without validators
+            return self.__api_call(method, url, payload, attempt, replayed)
+        if method == "POST" and response.status_code == 202:
+            return response
         if response.status_code != 200:
             log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
             logger.error(f"{log_msg}")
@@ -191,72 +261,33 @@ class XIQ:
             except json.JSONDecodeError:
                 logger.warning(f"\t\t{response.text}")
             else:
-                if 'error_message' in data:
+                if isinstance(data, dict) and 'error_message' in data:
                     logger.warning(f"\t\t{data['error_message']}")
+                    log_msg += f" - {data['error_message']}"
                 else:
                     logger.warning(f"{data}")
-            raise ValueError(log_msg) 
-        return "Success"
-
-    def __post_api_call(self, url, payload):
+            raise APIHTTPError(log_msg, response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        if method == "PUT":
+            return "Success"
         try:
-            response = requests.post(url, headers= self.headers, data=payload)
-        except HTTPError as http_err:
-            logger.error(f'HTTP error occurred: {http_err} - on API {url}')
-            raise ValueError(f'HTTP error occurred: {http_err}') 
-        if response is None:
-            log_msg = "ERROR: No response received from XIQ!"
-            logger.error(log_msg)
-            raise ValueError(log_msg)
-        if response.status_code == 202:
-            return response
-        elif response.status_code != 200:
-            log_msg = f"Error - HTTP Status Code: {str(response.status_code)}"
-            logger.error(f"{log_msg}")
-            try:
+            with section(self.metrics, "json_decode"):
                 data = response.json()
-            except json.JSONDecodeError:
-                logger.warning(f"\t\t{response.text()}")
-            else:
-                if 'error_message' in data:
-                    logger.warning(f"\t\t{data['error_message']}")
-                    raise Exception(data['error_message'])
-            raise ValueError(log_msg)
-        try:
-            data = response.json()
         except json.JSONDecodeError:
             logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(response.status_code)}")
             raise ValueError("Unable to parse the data from json, script cannot proceed")
+        if cached:
+            self.response_cache.store(url, data, response.headers)
         return data
-      
+
     def __getAccessToken(self, user_name, password):
         info = "get XIQ token"
-        success = 0
         url = self.URL + "/login"
         payload = json.dumps({"username": user_name, "password": password})
-        for count in range(1, self.totalretries):
-            try:
-                data = self.__post_api_call(url=url,payload=payload)
-            except ValueError as e:
-                print(f"API to {info} failed attempt {count} of {self.totalretries} with {e}")
-            except Exception as e:
-                print(f"API to {info} failed with {e}")
-                print('script is exiting...')
-                raise SystemExit
-            except:
-                print(f"API to {info} failed attempt {count} of {self.totalretries} with unknown API error")
-            else:
-                success = 1
-                break
-        if success != 1:
-            print("failed to get XIQ token. Cannot continue to import")
-            print("exiting script...")
-            raise SystemExit
-        
+        data = self.__setup_post_api_call(info,url,payload)
+
         if "access_token" in data:
             #print("Logged in and Got access token: " + data["access_token"])
-            self.headers["Authorization"] = "Bearer " + data["access_token"]
-            return 0
+            return data["access_token"], data.get("expires_in")
 
         else:
             log_msg = "Unknown Error: Unable to gain access token for XIQ"
@@ -273,6 +304,9 @@ class XIQ:
             response = self.__setup_put_api_call(info,url,payload)
         except APICallFailedException as e:
             response = "Failed"
+        if response == "Success" and self.response_cache is not None:
+            # devices become mismatched, cached device lists are out of date
+            self.response_cache.invalidate()
         return response
     
     # LRO
@@ -287,64 +321,439 @@ class XIQ:
     
     # Devices
     ## Check for config mismatches
-    def collectMismatchDevices(self, pageSize=100, location_id=None, wait_time = 0):
+    def collectMismatchDevices(self, pageSize=None, location_id=None, wait_time = 0, views="BASIC", fields=None):
+        # returns Device records, which still answer device['id'] style lookups for the fields they keep
+        return list(self.iter_mismatch_devices(pageSize=pageSize, location_id=location_id, wait_time=wait_time,
+                                               views=views, fields=fields))
+
+    def scan_locations(self, location_ids, workers=4, views="BASIC", fields=("ID",)):
+        # mismatched devices of every location, up to workers locations are scanned at once.
+        # Returns {location id: devices sorted by id}. A device that is found under more than one location
+        # (a parent and a child location were both listed) is only kept for the first of them
+        def scan(location_id):
+            return sorted(self.iter_mismatch_devices(location_id=location_id, views=views, fields=list(fields)),
+                          key=lambda device: device.id)
+
+        workers = max(1, min(workers, len(location_ids)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scans = list(executor.map(scan, location_ids))
+        devices_by_location = {}
+        seen = set()
+        for location_id, devices in zip(location_ids, scans):
+            devices_by_location[location_id] = [device for device in devices if device.id not in seen]
+            seen.update(device.id for device in devices)
+        return devices_by_location
+
+    # Locations
+    def collectLocations(self):
+        info = "to collect the location tree"
+        url = self.URL + "/locations/tree"
+        return self.__setup_get_api_call(info,url)
+
+    def discover_locations(self, location_type="BUILDING"):
+        # ids of every location of location_type (e.g. SITE, BUILDING or FLOOR) in the location tree
+        location_ids = []
+        nodes = list(self.collectLocations())
+        while nodes:
+            node = nodes.pop(0)
+            if str(node.get('type', '')).upper() == location_type.upper():
+                location_ids.append(node['id'])
+            nodes.extend(node.get('children') or [])
+        logger.info(f"found {len(location_ids)} locations of type {location_type}")
+        return location_ids
+
+    def iter_mismatch_devices(self, pageSize=None, location_id=None, wait_time = 0, views="BASIC", fields=None):
+        # yields mismatched devices page by page. views/fields limit what XIQ returns for each device,
+        # e.g. fields=["ID", "HOSTNAME"]
         info = "to collect mismatch devices" 
-        page = 1
-        pageCount = 1
-        firstCall = True
+        if pageSize is None:
+            pageSize = self.page_size
         if wait_time:
             print(f"Waiting {wait_time} seconds before checking for mismatched devices")
             time.sleep(wait_time)
-        devices = []
-        while page <= pageCount:
-            url = self.URL + "/devices?views=FULL&page=" + str(page) + "&limit=" + str(pageSize) + "&connected=true&configMismatch=true"
-            if location_id:
-                url = url  + "&locationId=" +str(location_id)
-            try:
-                rawList = self.__setup_get_api_call(info,url)
-            except APICallFailedException as e:
-                raise APICallFailedException(e)
-            devices = devices + rawList['data']
 
-            if firstCall == True:
-                pageCount = rawList['total_pages']
-            print(f"completed page {page} of {rawList['total_pages']} collecting Devices")
-            page = rawList['page'] + 1 
-        return devices
+        def page_url(page):
+            return build_mismatch_devices_url(self.URL, page, pageSize, views, fields, location_id)
+
+        for rawList in self.__iter_pages(info, page_url):
+            logger.debug(f"completed page {rawList['page']} of {rawList['total_pages']} collecting Devices",
+                         extra={'endpoint': "/devices"})
+            # only the fields in app.devices.Device are kept, the page dict is dropped right away
+            yield from parse_devices(rawList['data'])
+
+    def __iter_pages(self, info, page_url):
+        # the first page is needed to learn how many pages there are
+        rawList = self.__setup_get_api_call(info,page_url(1))
+        pageCount = rawList['total_pages']
+        yield rawList
+        if pageCount <= 1:
+            return
+        # remaining pages are collected concurrently and handed back in page order. Only page_workers
+        # pages are in flight or waiting at any time so memory stays flat for large tenants
+        workers = max(1, min(self.page_workers, pageCount - 1))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        next_page = 2
+        try:
+            while next_page <= pageCount and len(pending) < workers:
+                pending.append(executor.submit(self.__setup_get_api_call, info, page_url(next_page)))
+                next_page += 1
+            while pending:
+                rawList = pending.popleft().result()
+                if next_page <= pageCount:
+                    pending.append(executor.submit(self.__setup_get_api_call, info, page_url(next_page)))
+                    next_page += 1
+                yield rawList
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
 
-    def configPushToDevices(self, device_id_list):
+    def configPushToDevices(self, device_id_list, tracker=None):
+        # tracker is an optional DeploymentTracker that is updated for these devices on every LRO check
         info = "to push delta config update to devices"
         url = self.URL + "/deployments?async=true"
-        payload = json.dumps({
-        "devices": {
-            "ids": 
-            device_id_list
-        },
-        "policy": {
-            "enable_complete_configuration_update": False,
-            "firmware_upgrade_policy": {
-            "enable_enforce_upgrade": False,
-            "enable_distributed_upgrade": False
-            },
-            "firmware_activate_option": {
-            "enable_activate_at_next_reboot": False,
-            "activation_delay_seconds": 0,
-            "activation_time": 0
-            }
-        }
-        })
-        try:
+        payload = build_deployment_payload(device_id_list)
+        with stage(self.metrics, "push"):
             response = self.__setup_post_api_call(info,url,payload)
-        except APICallFailedException as e:
-            raise APICallFailedException(e)
-        # wait 60 seconds
-        wait_time = 60
-        print(f"waiting {wait_time} seconds for configuration push to start.")
-        time.sleep(wait_time)
-        #check LRO 
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
+        # poll the LRO until it reaches a final status or lro_timeout passes
+        logger.info(f"waiting up to {self.lro_timeout} seconds for configuration push to complete.")
+        lro_url = response.headers['Location']
+
+        def check():
+            status = self.__check_LRO(lro_url)
+            if tracker is not None:
+                self.__update_tracker(tracker, device_id_list)
+            return status
+
         try:
-            lro_response = self.__check_LRO(response.headers['Location'])
+            with stage(self.metrics, "lro"):
+                lro_response, finished = self.poller.poll(check, lambda status: status not in LRO_ACTIVE_STATUSES,
+                                                          self.lro_timeout, info="configuration push")
         except APICallFailedException as e:
-            raise APICallFailedException(e)
+            # XIQ accepted the deployment, only its status is unknown
+            logger.warning(f"unable to get the status of the configuration push to {len(device_id_list)} devices - {e}")
+            lro_response = LRO_UNKNOWN
+        if self.response_cache is not None:
+            self.response_cache.invalidate()
         return lro_response
 
+    def __update_tracker(self, tracker, device_id_list):
+        # progress is only informational, a failed status call does not stop the push
+        try:
+            tracker.update(device_id_list)
+        except APICallFailedException as e:
+            logger.warning(f"unable to get the deployment status of the devices - {e}")
+
+    def get_deployment_status(self, device_id_list):
+        # per device deployment status keyed by device id
+        info = "to get the deployment status of devices"
+        url = self.URL + "/deployments/status?deviceIds=" + ",".join(str(device_id) for device_id in device_id_list)
+        return self.__setup_get_api_call(info,url)
+
+    def configPushInBatches(self, device_id_list):
+        # Pushes the config in batches of push_batch_size devices with up to push_workers deployments
+        # running at once. Returns {'status': overall status, 'devices': {device id: status}, 'batches': [...]}
+        batch_size = self.push_batch_size or len(device_id_list) or 1
+        batches = [device_id_list[i:i + batch_size] for i in range(0, len(device_id_list), batch_size)]
+        workers = max(1, min(self.push_workers, len(batches)))
+        tracker = None
+        if self.track_deployments:
+            tracker = DeploymentTracker(self.get_deployment_status, device_id_list, page_size=self.page_size,
+                                        metrics=self.metrics)
+        logger.info(f"pushing configuration to {len(device_id_list)} devices in {len(batches)} batches")
+        with stage(self.metrics, "config_push"), ThreadPoolExecutor(max_workers=workers) as executor:
+            batch_results = list(executor.map(self.__push_batch, range(1, len(batches) + 1), batches,
+                                              [tracker] * len(batches)))
+        devices = {}
+        for batch_result in batch_results:
+            for device_id in batch_result['device_ids']:
+                # the device's own final state when it is known, otherwise that of its batch
+                if tracker is not None and tracker.states[device_id] in (SUCCEEDED, FAILED):
+                    devices[device_id] = tracker.state(device_id)
+                else:
+                    devices[device_id] = batch_result['status']
+        retry_devices = [device_id for device_id, status in devices.items() if status != "SUCCEEDED"]
+        if retry_devices:
+            logger.warning(f"{len(retry_devices)} devices failed or are still pending and need another push: "
+                           f"{', '.join(str(device_id) for device_id in retry_devices)}")
+        return {'status': combine_push_statuses([batch_result['status'] for batch_result in batch_results]),
+                'devices': devices, 'batches': batch_results, 'retry_devices': retry_devices}
+
+    def configPushBySite(self, devices_by_location, sites_in_flight=1, stop_on_failure=True):
+        # Staged rollout: each location is pushed with configPushInBatches, sites_in_flight locations at a
+        # time in the given order. With stop_on_failure no new location is started after one did not
+        # succeed, its devices and those of every later location are reported as SKIPPED.
+        # Returns the configPushInBatches result with an extra 'sites': {location id: status}
+        sites = [(location_id, device_ids) for location_id, device_ids in devices_by_location.items() if device_ids]
+        stopped = threading.Event()
+
+        def push_site(site):
+            location_id, device_ids = site
+            if stop_on_failure and stopped.is_set():
+                return {'status': "SKIPPED", 'devices': {device_id: "SKIPPED" for device_id in device_ids}, 'batches': [],
+                        'retry_devices': list(device_ids)}
+            logger.info(f"pushing configuration to location {location_id}")
+            site_result = self.configPushInBatches(device_ids)
+            if site_result['status'] != "SUCCEEDED":
+                logger.warning(f"configuration push to location {location_id} {site_result['status']}")
+                stopped.set()
+            return site_result
+
+        workers = max(1, min(sites_in_flight, len(sites)))
+        with stage(self.metrics, "rollout"), ThreadPoolExecutor(max_workers=workers) as executor:
+            site_results = list(executor.map(push_site, sites))
+        push_result = {'status': combine_push_statuses([site_result['status'] for site_result in site_results]),
+                       'devices': {}, 'batches': [], 'retry_devices': [], 'sites': {}}
+        for (location_id, device_ids), site_result in zip(sites, site_results):
+            push_result['devices'].update(site_result['devices'])
+            push_result['batches'].extend(site_result['batches'])
+            push_result['retry_devices'].extend(site_result['retry_devices'])
+            push_result['sites'][location_id] = site_result['status']
+        return push_result
+
+    def __push_batch(self, number, device_id_list, tracker=None):
+        # one deployment for the batch. Only batches that ended in a failure are pushed again, a batch
+        # that is still running after lro_timeout or whose status could not be read is left alone so the
+        # same devices are not deployed twice.
+        # With a tracker a retry only pushes the devices of the batch that did not succeed
+        batch_result = {'batch': number, 'device_ids': device_id_list, 'status': None, 'attempts': 0, 'error': None}
+        targets = device_id_list
+        for attempt in range(1 + self.push_batch_retries):
+            batch_result['attempts'] += 1
+            if attempt and tracker is not None:
+                targets = tracker.not_succeeded(device_id_list) or device_id_list
+                tracker.restart(targets)
+            try:
+                batch_result['status'] = self.configPushToDevices(targets, tracker)
+                batch_result['error'] = None
+            except APICallFailedException as e:
+                batch_result['status'] = "FAILED"
+                batch_result['error'] = str(e)
+            if batch_result['status'] in ("SUCCEEDED", LRO_UNKNOWN) or batch_result['status'] in LRO_ACTIVE_STATUSES:
+                break
+            if attempt < self.push_batch_retries:
+                logger.warning(f"config push batch {number} ({len(device_id_list)} devices) "
+                               f"{batch_result['status']}, pushing it again")
+        if batch_result['status'] != "SUCCEEDED":
+            logger.error(f"config push batch {number} ({len(device_id_list)} devices) ended as "
+                         f"{batch_result['status']} after {batch_result['attempts']} attempts"
+                         + (f" - {batch_result['error']}" if batch_result['error'] else ""))
+        return batch_result
+
+
+class AsyncXIQ:
+    # asyncio version of XIQ. All calls share one aiohttp session and at most max_in_flight
+    # requests are sent to XIQ at the same time, so many SSIDs or tenants can be driven from
+    # a single event loop. Use it as an async context manager:
+    #     async with AsyncXIQ(token=token) as x:
+    #         await x.change_PSK(ssid_id, psk)
+    # It shares the retry policy, rate limiter, poller and payload builders with XIQ but not these XIQ
+    # features: the TokenManager (a login token is not cached or renewed, a 401 is not replayed), the
+    # response cache, batched pushes and deployment tracking. aiohttp is an optional requirement.
+    def __init__(self, user_name=None, password=None, token=None, max_in_flight=10, connect_timeout=10, read_timeout=60,
+                 page_size=100, poll_interval=2, poll_max_interval=30, lro_timeout=600, retry_policy=None,
+                 rate_limiter=None, base_url="https://api.extremecloudiq.com", metrics=None):
+        global aiohttp
+        if aiohttp is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError("aiohttp is required for AsyncXIQ - pip install aiohttp")
+        self.URL = base_url.rstrip('/')
+        self.metrics = metrics
+        self.headers = {"Accept": "application/json", "Content-Type": "application/json"}
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.page_size = page_size
+        self.max_in_flight = max_in_flight
+        self.poller = Poller(initial_interval=poll_interval, max_interval=poll_max_interval)
+        self.lro_timeout = lro_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.user_name = user_name
+        self.password = password
+        if token:
+            self.headers["Authorization"] = "Bearer " + token
+        # the session and semaphore belong to the running event loop so they are created in open()
+        self.session = None
+        self.semaphore = None
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        if "Authorization" not in self.headers:
+            await self.__getAccessToken(self.user_name, self.password)
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    #API CALLS
+    async def __api_call(self, method, url, payload=None, attempt=1):
+        # returns (status_code, headers, body text) - raises ValueError for anything that should be retried
+        wait = self.rate_limiter.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        status, response_bytes = "error", 0
+        start = time.perf_counter()
+        try:
+            async with self.semaphore:
+                start = time.perf_counter()
+                async with self.session.request(method, url, headers=self.headers, data=payload) as response:
+                    body = await response.read()
+                    status, response_bytes = response.status, len(body)
+                    self.rate_limiter.update(response.status, response.headers)
+                    return response.status, response.headers, body.decode(response.get_encoding() if body else "utf-8")
+        except asyncio.TimeoutError:
+            logger.error(f'Timeout occurred - on API {url}')
+            raise ValueError('Timeout occurred')
+        except aiohttp.ClientError as client_err:
+            logger.error(f'HTTP error occurred: {client_err} - on API {url}')
+            raise ValueError(f'HTTP error occurred: {client_err}')
+        finally:
+            latency = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.record_call(method, url, status, latency, response_bytes, attempt - 1)
+            logger.debug(f"{method} {url} - {status} in {latency:.3f} seconds",
+                         extra={'endpoint': endpoint_name(url), 'latency': round(latency, 6)})
+
+    async def __setup_api_call(self, info, method, url, payload=None):
+        count = 1
+        while True:
+            if not self.retry_policy.allow():
+                log_msg = (f"failed to {info}. XIQ is not responding, calls are paused by the circuit breaker.")
+                logger.error(log_msg)
+                raise APICallFailedException(log_msg)
+            try:
+                status, headers, text = await self.__api_call(method, url, payload, count)
+                if status not in (200, 202):
+                    log_msg = f"Error - HTTP Status Code: {str(status)}"
+                    logger.error(f"{log_msg}")
+                    logger.warning(f"\t\t{text}")
+                    raise APIHTTPError(log_msg, status, parse_retry_after(headers.get('Retry-After')))
+                if status == 202 or method == "PUT":
+                    response = headers
+                else:
+                    try:
+                        response = json.loads(text)
+                    except json.JSONDecodeError:
+                        # retried like the sync client, the body may have been cut short
+                        logger.error(f"Unable to parse json data - {url} - HTTP Status Code: {str(status)}")
+                        raise ValueError("Unable to parse the data from json")
+            except ValueError as e:
+                delay = self.retry_policy.on_error(count, e, info, endpoint_name(url))
+                if delay is None:
+                    raise APICallFailedException(f"failed to {info} on attempt {count} with {e}. Cannot continue. "
+                                                 f"Check log file for details")
+                await asyncio.sleep(delay)
+                count += 1
+            else:
+                self.retry_policy.on_success()
+                break
+        if status == 202 or method == "PUT":
+            return response
+        if isinstance(response, dict) and 'error' in response:
+            if response['error']['error_message']:
+                log_msg = (f"Error Code {response['error']['error_id']}: {response['error']['error_message']}")
+                logger.error(log_msg)
+                log_msg = (f"API Failed {info} with reason: {log_msg}")
+                raise APICallFailedException(log_msg)
+        return response
+
+    async def __getAccessToken(self, user_name, password):
+        info = "get XIQ token"
+        url = self.URL + "/login"
+        payload = json.dumps({"username": user_name, "password": password})
+        data = await self.__setup_api_call(info, "POST", url, payload)
+        if "access_token" in data:
+            self.headers["Authorization"] = "Bearer " + data["access_token"]
+            return 0
+        else:
+            log_msg = "Unknown Error: Unable to gain access token for XIQ"
+            logger.warning(log_msg)
+            raise ValueError(log_msg)
+
+    # PSK
+    async def change_PSK(self, ssid_id, psk):
+        info = "to change psk"
+        url = f"{self.URL}/ssids/{ssid_id}/psk/password"
+        try:
+            await self.__setup_api_call(info, "PUT", url, psk)
+        except APICallFailedException as e:
+            return "Failed"
+        return "Success"
+
+    # LRO
+    async def check_LRO(self, url):
+        info = "to check LRO status"
+        response = await self.__setup_api_call(info, "GET", url)
+        return response['metadata']["status"]
+
+    # Devices
+    ## Check for config mismatches
+    async def collectMismatchDevices(self, pageSize=None, location_id=None, wait_time=0, views="BASIC", fields=None):
+        devices = []
+        async for device in self.iter_mismatch_devices(pageSize=pageSize, location_id=location_id, wait_time=wait_time,
+                                                       views=views, fields=fields):
+            devices.append(device)
+        return devices
+
+    async def iter_mismatch_devices(self, pageSize=None, location_id=None, wait_time=0, views="BASIC", fields=None):
+        info = "to collect mismatch devices"
+        if wait_time:
+            logger.info(f"Waiting {wait_time} seconds before checking for mismatched devices")
+            await asyncio.sleep(wait_time)
+        if pageSize is None:
+            pageSize = self.page_size
+        rawList = await self.__setup_api_call(info, "GET", build_mismatch_devices_url(self.URL, 1, pageSize, views, fields, location_id))
+        pageCount = rawList['total_pages']
+        for device in parse_devices(rawList['data']):
+            yield device
+        # remaining pages are requested concurrently and handed back in page order. Only max_in_flight
+        # pages are requested or waiting at any time
+        def fetch(page):
+            url = build_mismatch_devices_url(self.URL, page, pageSize, views, fields, location_id)
+            return asyncio.ensure_future(self.__setup_api_call(info, "GET", url))
+
+        pending = deque()
+        next_page = 2
+        try:
+            while next_page <= pageCount and len(pending) < self.max_in_flight:
+                pending.append(fetch(next_page))
+                next_page += 1
+            while pending:
+                rawList = await pending.popleft()
+                if next_page <= pageCount:
+                    pending.append(fetch(next_page))
+                    next_page += 1
+                for device in parse_devices(rawList['data']):
+                    yield device
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def configPushToDevices(self, device_id_list):
+        info = "to push delta config update to devices"
+        url = self.URL + "/deployments?async=true"
+        with stage(self.metrics, "push"):
+            headers = await self.__setup_api_call(info, "POST", url, build_deployment_payload(device_id_list))
+        lro_url = headers['Location']
+        with stage(self.metrics, "lro"):
+            lro_response, finished = await self.poller.poll_async(lambda: self.check_LRO(lro_url),
+                                                                  lambda status: status not in LRO_ACTIVE_STATUSES,
+                                                                  self.lro_timeout, info="configuration push")
+        return lro_response
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#########################################################################################
+# Measures the cold start time of the rotator. Each case is run in a fresh interpreter
+# and the median of several runs is reported.
+#
+#   python tools/bench_import.py --runs 10
+#########################################################################################
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ("python startup", "pass"),
+    ("rotator, email_type smtp/disabled", "import app.rotator, app.email_backends as e; e.load_backend('smtp'); e.load_backend('disabled')"),
+    ("rotator, email_type gmail", "import app.rotator, app.email_backends as e; e.load_backend('gmail')"),
+    ("rotator + eager gmail/smtp imports (before backend registry)", "import app.rotator, app.gmail, app.smtp"),
+]
+
+
+def time_case(code, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+    return statistics.median(timings), None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cold start import benchmark")
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+    print(f"{'case':<62} {'median ms':>10}")
+    for name, code in CASES:
+        median, error = time_case(code, args.runs)
+        if error:
+            print(f"{name:<62} {'failed':>10}  {error}")
+        else:
+            print(f"{name:<62} {median * 1000:>10.1f}")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#########################################################################################
+# Memory held by a mismatch scan of a large tenant: the full views=FULL device dicts
+# against the compact app.devices.Device records. Pages are built by the mock server's
+# device generator, serialized and decoded one at a time like real /devices responses.
+#
+#   python tools/bench_memory.py --devices 100000
+#########################################################################################
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(PATH)
+sys.path.insert(0, PATH)
+sys.path.insert(0, ROOT)
+from mock_xiq import MockXIQState
+from app.devices import parse_devices
+
+
+def make_pages(devices, page_size, views):
+    # serialized /devices pages, as they arrive from XIQ
+    state = MockXIQState(devices=devices)
+    pages = []
+    for start in range(0, devices, page_size):
+        data = [state.device(index, views, None) for index in range(start, min(start + page_size, devices))]
+        pages.append(json.dumps({"page": len(pages) + 1, "data": data}).encode())
+    return pages
+
+
+def measure(pages, keep):
+    # returns (MB still held after the scan, peak MB during the scan)
+    gc.collect()
+    tracemalloc.start()
+    held = []
+    for page in pages:
+        held.extend(keep(json.loads(page)['data']))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return current / (1024 * 1024), peak / (1024 * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Memory held by full device dicts and compact Device records")
+    parser.add_argument('--devices', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'records':<30} {'held MB':>10} {'peak MB':>10}")
+    for views in ("FULL", "BASIC"):
+        pages = make_pages(args.devices, args.page_size, views)
+        for name, keep in ((f"{views} dicts", lambda data: data), (f"{views} -> Device", parse_devices)):
+            held, peak = measure(pages, keep)
+            print(f"{name:<30} {held:>10.1f} {peak:>10.1f}")
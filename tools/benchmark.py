@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#########################################################################################
+# Runs the full XIQ_PSK_Rotator.py flow against the local mock XIQ server and reports
+# wall time, API calls and peak memory of the rotator process for each fleet size.
+#
+#   python tools/benchmark.py
+#   python tools/benchmark.py --sizes 100 10000 --latency 0.05 --json bench.json
+#########################################################################################
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import yaml
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(PATH)
+sys.path.insert(0, PATH)
+from mock_xiq import MockXIQState, start_server, add_state_arguments
+
+
+def write_config(work_dir, base_url, args):
+    psk_file = os.path.join(work_dir, "psk_list.csv")
+    with open(psk_file, "w") as f:
+        f.write("".join(f"BenchPSK{index:08d}\n" for index in range(10)))
+    variables = {
+        "XIQ_token": "bench-token",
+        "XIQ_url": base_url,
+        "SSID_ID": 1,
+        "allow_mismatched": True,
+        "allow_config_push": True,
+        "reuse_psks": True,
+        "file_name": psk_file,
+        "email_type": "disabled",
+        "email_list": ["bench@example.com"],
+        "support_email_list": ["bench@example.com"],
+        "email_sub": "Benchmark",
+        "email_msg": "The new PSK is",
+        "page_workers": args.page_workers,
+        "XIQ_pool_size": args.page_workers,
+        "rate_limit": args.client_rate_limit,
+        "rate_burst": args.client_rate_limit,
+        "poll_interval": 0.5,
+        "poll_max_interval": 2,
+        "mismatch_timeout": args.mismatch_timeout,
+    }
+    if args.locations:
+        variables.update({"locations": "discover", "location_workers": args.location_workers,
+                          "sites_in_flight": args.sites_in_flight})
+    config = os.path.join(work_dir, "variables.yml")
+    with open(config, "w") as f:
+        yaml.safe_dump(variables, f)
+    return config
+
+
+def run_rotator(config):
+    # returns (exit code, wall seconds, peak rss in MB, output) of one XIQ_PSK_Rotator.py run
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, "XIQ_PSK_Rotator.py"), "--config", config],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on linux and bytes on macOS
+    peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return process.returncode, wall, peak, output.decode(errors="replace")
+
+
+def benchmark(size, args):
+    state = MockXIQState(devices=size, initial_mismatched=args.initial_mismatched, mismatch_delay=args.mismatch_delay,
+                         lro_time=args.lro_time, latency=args.latency, error_rate=args.error_rate,
+                         throttle_rate=args.throttle_rate, retry_after=args.retry_after, rate_limit=args.rate_limit)
+    server = start_server(state)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            config = write_config(work_dir, base_url, args)
+            code, wall, peak, output = run_rotator(config)
+        with urllib.request.urlopen(f"{base_url}/_stats") as response:
+            stats = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+    if code != 0 or args.verbose:
+        print(output)
+    return {"devices": size, "exit_code": code, "wall_seconds": round(wall, 3), "api_calls": stats["total"],
+            "calls": stats["calls"], "peak_rss_mb": round(peak, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark XIQ_PSK_Rotator.py against the mock XIQ server")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000], help="fleet sizes to run")
+    parser.add_argument('--page-workers', type=int, default=4)
+    parser.add_argument('--client-rate-limit', type=float, default=1000, help="rate_limit used by the rotator")
+    parser.add_argument('--mismatch-timeout', type=float, default=60)
+    parser.add_argument('--locations', action='store_true', help="scan and push location by location")
+    parser.add_argument('--location-workers', type=int, default=4)
+    parser.add_argument('--sites-in-flight', type=int, default=4)
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="print the rotator output")
+    add_state_arguments(parser)
+    parser.set_defaults(lro_time=2)
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'devices':>10} {'exit':>5} {'wall s':>10} {'API calls':>10} {'peak MB':>10}")
+    for size in args.sizes:
+        result = benchmark(size, args)
+        results.append(result)
+        print(f"{result['devices']:>10} {result['exit_code']:>5} {result['wall_seconds']:>10} "
+              f"{result['api_calls']:>10} {result['peak_rss_mb']:>10}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
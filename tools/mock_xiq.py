@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+#########################################################################################
+# Local stand-in for the XIQ API endpoints used by XIQ_PSK_Rotator.py
+#
+#   POST /login                          - returns an access token (valid for token_lifetime seconds if set)
+#   PUT  /ssids/{id}/psk/password        - changes the PSK, devices become mismatched
+#   GET  /devices                        - paginated, supports configMismatch/connected/views/fields/locationId
+#                                          and ETag/If-None-Match (304)
+#   GET  /locations/tree                 - Global with one BUILDING per site, devices are spread over the sites
+#   POST /deployments?async=true         - returns 202 with a Location header for the LRO
+#   GET  /operations/{id}                - LRO status, SUCCEEDED (or PARTIAL_SUCCEEDED) after lro_time seconds
+#   GET  /deployments/status?deviceIds=  - per device deployment status
+#   GET  /_stats  POST /_reset           - call counters for benchmarks
+#
+# Run it stand alone with:
+#   python tools/mock_xiq.py --port 8080 --devices 10000 --latency 0.05
+# and set XIQ_url: "http://127.0.0.1:8080" in variables.yml
+#########################################################################################
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# devices are spread round robin over this many sites, site n has location id 1000 + n
+SITES = 200
+
+
+class MockXIQState:
+    def __init__(self, devices=100, initial_mismatched=0, mismatch_delay=0, lro_time=5, latency=0,
+                 error_rate=0, throttle_rate=0, retry_after=1, rate_limit=None, max_page_size=100, token_lifetime=None,
+                 device_failure_rate=0):
+        self.device_count = devices
+        self.initial_mismatched = initial_mismatched
+        self.mismatch_delay = mismatch_delay
+        self.lro_time = lro_time
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.max_page_size = max_page_size
+        # with token_lifetime only tokens from /login are accepted, and only until they expire
+        self.token_lifetime = token_lifetime
+        # fraction of devices whose first deployment fails, the same devices every run
+        self.device_failure_rate = device_failure_rate
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = Counter()
+            self.psk_changed_at = None
+            self.pushed = False
+            self.operations = {}
+            # device id -> (deployment start, number of deployments)
+            self.deployments = {}
+            self.window_start = time.monotonic()
+            self.window_calls = 0
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def over_rate_limit(self):
+        # fixed one second window quota
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_calls = 0
+            self.window_calls += 1
+            return self.window_calls > self.rate_limit
+
+    def mismatched_count(self):
+        with self.lock:
+            if self.pushed:
+                return 0
+            if self.psk_changed_at is not None and time.monotonic() - self.psk_changed_at >= self.mismatch_delay:
+                return self.device_count
+            return min(self.initial_mismatched, self.device_count)
+
+    def deployment_failed(self, device_id, attempt):
+        return attempt == 1 and (device_id * 2654435761) % 1000 < self.device_failure_rate * 1000
+
+    def device_status(self, device_id):
+        with self.lock:
+            deployment = self.deployments.get(device_id)
+        if deployment is None:
+            return None
+        started, attempt = deployment
+        if time.monotonic() - started < self.lro_time:
+            return {"finished": False, "status": "RUNNING"}
+        if self.deployment_failed(device_id, attempt):
+            return {"finished": True, "status": "FAILED", "failure_reason": "Device did not respond"}
+        return {"finished": True, "status": "SUCCEEDED"}
+
+    def device(self, index, views, fields):
+        device = {"id": 100000000 + index, "hostname": f"AP-{index:06d}"}
+        if views == "FULL":
+            device.update({
+                "serial_number": f"SN{index:012d}",
+                "mac_address": f"{index:012X}",
+                "device_function": "AP",
+                "product_type": "AP_305C",
+                "ip_address": f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+                "software_version": "10.6.5.0",
+                "location_id": 1000 + index % SITES,
+                "connected": True,
+                "config_mismatch": True,
+                "network_policy_name": "Guest-Policy",
+                "locations": [{"id": 1, "name": "Global"}, {"id": 1000 + index % SITES, "name": f"Site {index % SITES}"}],
+            })
+        if fields:
+            wanted = [field.lower() for field in fields]
+            device = {key: value for key, value in device.items() if key in wanted}
+        return device
+
+
+def make_handler(state):
+    class MockXIQHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, data, headers=None):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def injected_failure(self):
+            # returns True if an error, throttle or 401 response was sent instead of the real one
+            if state.latency:
+                time.sleep(state.latency)
+            if state.token_lifetime and urlparse(self.path).path != "/login":
+                token = (self.headers.get("Authorization") or "").replace("Bearer ", "")
+                with state.lock:
+                    expires_at = state.tokens.get(token, 0)
+                if time.monotonic() >= expires_at:
+                    state.count("401")
+                    self.send_json(401, {"error_message": "Invalid or expired token"})
+                    return True
+            if state.over_rate_limit() or (state.throttle_rate and random.random() < state.throttle_rate):
+                state.count("429")
+                self.send_json(429, {"error_message": "Too many requests"}, {"Retry-After": str(state.retry_after)})
+                return True
+            if state.error_rate and random.random() < state.error_rate:
+                state.count("503")
+                self.send_json(503, {"error_message": "Service unavailable"})
+                return True
+            return False
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/_stats":
+                with state.lock:
+                    self.send_json(200, {"calls": dict(state.calls), "total": sum(state.calls.values())})
+                return
+            if self.injected_failure():
+                return
+            if url.path == "/devices":
+                state.count("GET /devices")
+                page = int(query.get("page", ["1"])[0])
+                limit = min(int(query.get("limit", ["10"])[0]), state.max_page_size)
+                views = query.get("views", ["BASIC"])[0]
+                fields = query.get("fields")
+                if query.get("configMismatch", ["false"])[0] == "true":
+                    total = state.mismatched_count()
+                else:
+                    total = state.device_count
+                indexes = range(total)
+                if "locationId" in query:
+                    site = int(query["locationId"][0]) - 1000
+                    indexes = range(site, total, SITES) if 0 <= site < SITES else range(0)
+                total = len(indexes)
+                # the page only changes with the mismatched device count
+                etag = '"' + hashlib.sha1(f"{url.query}|{total}".encode()).hexdigest()[:16] + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    state.count("304")
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                total_pages = (total + limit - 1) // limit
+                start = (page - 1) * limit
+                data = [state.device(index, views, fields) for index in indexes[start:start + limit]]
+                self.send_json(200, {"page": page, "count": len(data), "total_pages": total_pages,
+                                     "total_count": total, "data": data}, {"ETag": etag})
+                return
+            if url.path == "/locations/tree":
+                state.count("GET /locations/tree")
+                sites = [{"id": 1000 + site, "name": f"Site {site}", "type": "BUILDING", "children": []}
+                         for site in range(SITES)]
+                self.send_json(200, [{"id": 1, "name": "Global", "type": "GLOBAL", "children": sites}])
+                return
+            match = re.fullmatch(r"/operations/(\d+)", url.path)
+            if match:
+                state.count("GET /operations")
+                with state.lock:
+                    operation = state.operations.get(match.group(1))
+                if operation is None:
+                    self.send_json(404, {"error_message": "Operation not found"})
+                    return
+                started, device_ids = operation
+                done = time.monotonic() - started >= state.lro_time
+                status = "RUNNING"
+                if done:
+                    with state.lock:
+                        state.pushed = True
+                    failed = sum(1 for device_id in device_ids
+                                 if state.device_status(device_id).get("status") == "FAILED")
+                    status = "SUCCEEDED" if not failed else "FAILED" if failed == len(device_ids) else "PARTIAL_SUCCEEDED"
+                self.send_json(200, {"metadata": {"status": status}})
+                return
+            if url.path == "/deployments/status":
+                state.count("GET /deployments/status")
+                device_ids = [int(device_id) for device_id in ",".join(query.get("deviceIds", [])).split(",") if device_id]
+                statuses = {str(device_id): state.device_status(device_id) for device_id in device_ids}
+                self.send_json(200, {device_id: status for device_id, status in statuses.items() if status is not None})
+                return
+            self.send_json(404, {"error_message": f"Unknown path {url.path}"})
+
+        def do_PUT(self):
+            url = urlparse(self.path)
+            self.read_body()
+            if self.injected_failure():
+                return
+            if re.fullmatch(r"/ssids/\d+/psk/password", url.path):
+                state.count("PUT /ssids/psk/password")
+                with state.lock:
+                    state.psk_changed_at = time.monotonic()
+                    state.pushed = False
+                self.send_json(200, {})
+                return
+            self.send_json(404, {"error_message": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            body = self.read_body()
+            if url.path == "/_reset":
+                state.reset()
+                self.send_json(200, {})
+                return
+            if self.injected_failure():
+                return
+            if url.path == "/login":
+                state.count("POST /login")
+                lifetime = state.token_lifetime or 86400
+                with state.lock:
+                    token = f"mock-token-{len(state.tokens) + 1}"
+                    state.tokens[token] = time.monotonic() + lifetime
+                self.send_json(200, {"access_token": token, "token_type": "Bearer", "expires_in": lifetime})
+                return
+            if url.path == "/deployments":
+                state.count("POST /deployments")
+                device_ids = json.loads(body or b"{}").get("devices", {}).get("ids", [])
+                with state.lock:
+                    operation_id = str(len(state.operations) + 1)
+                    started = time.monotonic()
+                    state.operations[operation_id] = (started, device_ids)
+                    for device_id in device_ids:
+                        state.deployments[device_id] = (started, state.deployments.get(device_id, (0, 0))[1] + 1)
+                host = self.headers.get("Host")
+                self.send_response(202)
+                self.send_header("Location", f"http://{host}/operations/{operation_id}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_json(404, {"error_message": f"Unknown path {url.path}"})
+
+    return MockXIQHandler
+
+
+def start_server(state, host="127.0.0.1", port=0):
+    # starts the mock server on a background thread and returns it. server.server_port has the port in use
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_state_arguments(parser):
+    parser.add_argument('--devices', type=int, default=100, help="number of connected devices in the fleet")
+    parser.add_argument('--initial-mismatched', type=int, default=0, help="devices already mismatched before the PSK change")
+    parser.add_argument('--mismatch-delay', type=float, default=0, help="seconds after the PSK change before devices show as mismatched")
+    parser.add_argument('--lro-time', type=float, default=5, help="seconds until a deployment LRO is SUCCEEDED")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to every response")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of calls answered with 503")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="fraction of calls answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1, help="Retry-After seconds sent with 429 responses")
+    parser.add_argument('--rate-limit', type=int, default=None, help="calls per second before 429 is returned")
+    parser.add_argument('--device-failure-rate', type=float, default=0,
+                        help="fraction of devices whose first deployment fails")
+    parser.add_argument('--token-lifetime', type=float, default=None, help="seconds a /login token is accepted, "
+                                                                             "other tokens are rejected with 401")
+
+
+def state_from_args(args):
+    return MockXIQState(devices=args.devices, initial_mismatched=args.initial_mismatched,
+                        mismatch_delay=args.mismatch_delay, lro_time=args.lro_time, latency=args.latency,
+                        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                        retry_after=args.retry_after, rate_limit=args.rate_limit, token_lifetime=args.token_lifetime,
+                        device_failure_rate=args.device_failure_rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mock XIQ API server")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    add_state_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(state_from_args(args), args.host, args.port)
+    print(f"Mock XIQ listening on http://{args.host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()